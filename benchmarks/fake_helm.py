@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+"""
+Stub `helm` binary for offline benchmarks of helm_shell.
+
+Behaviour is configured with environment variables:
+    FAKE_HELM_STATE (str): directory with state.json and calls.log
+    FAKE_HELM_LATENCY (float): seconds added to every call
+    FAKE_HELM_UPDATE_LATENCY (float): seconds added to 'helm repo update'
+    FAKE_HELM_MANIFEST_SIZE (int): size of rendered manifest in bytes
+    FAKE_HELM_INDEX_SIZE (int): number of filler charts in repo index
+    FAKE_HELM_FAIL_RELEASES (str): comma separated releases which fail to install
+    FAKE_HELM_FAIL_CONTEXTS (str): comma separated kube contexts which are unreachable
+    HELM_REPOSITORY_CONFIG (str): repositories.yaml written by 'helm repo add', FAKE_HELM_STATE by default
+    HELM_REPOSITORY_CACHE (str): directory of repo indexes written by 'helm repo add/update', FAKE_HELM_STATE by default
+"""
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import tarfile
+import time
+
+# Flags which take value as next argument
+VALUE_FLAGS = ['-n', '--namespace', '--version', '-f', '--values', '-o', '--output', '--timeout', '--kube-context',
+               '--kubeconfig', '--history-max', '--username', '--password', '--max', '--repo']
+
+STATE_DIR = os.environ.get('FAKE_HELM_STATE', os.path.join(os.getcwd(), 'fake_helm_state'))
+LATENCY = float(os.environ.get('FAKE_HELM_LATENCY', '0'))
+UPDATE_LATENCY = float(os.environ.get('FAKE_HELM_UPDATE_LATENCY', '0'))
+MANIFEST_SIZE = int(os.environ.get('FAKE_HELM_MANIFEST_SIZE', '2048'))
+INDEX_SIZE = int(os.environ.get('FAKE_HELM_INDEX_SIZE', '0'))
+FAIL_RELEASES = [release for release in os.environ.get('FAKE_HELM_FAIL_RELEASES', '').split(',') if release]
+FAIL_CONTEXTS = [context for context in os.environ.get('FAKE_HELM_FAIL_CONTEXTS', '').split(',') if context]
+REPOSITORY_CONFIG = os.environ.get('HELM_REPOSITORY_CONFIG', os.path.join(STATE_DIR, 'repositories.yaml'))
+REPOSITORY_CACHE = os.environ.get('HELM_REPOSITORY_CACHE', os.path.join(STATE_DIR, 'repository'))
+
+# Charts used by benchmark scenarios, every chart has the same versions in repo index
+INDEX_CHARTS = ['memcached', 'prometheus', 'bench'] + ['chart{0}'.format(index) for index in range(20)]
+INDEX_VERSIONS = ['0.9.0', '1.0.0', '1.0.1', '2.0.0-rc.1']
+
+
+def parse_args(argv):
+    """
+    Args:
+        argv (list): helm arguments
+    Returns:
+        list - positional arguments
+        dict - flags and their values
+    """
+    positional = []
+    flags = {}
+    index = 0
+    while index < len(argv):
+        arg = argv[index]
+        if arg.startswith('-') and '=' in arg:
+            flag, value = arg.split('=', 1)
+            flags[flag] = value.strip('"')
+        elif arg in VALUE_FLAGS and index + 1 < len(argv):
+            flags[arg] = argv[index + 1]
+            index += 1
+        elif arg.startswith('-') and arg != '-':
+            flags[arg] = True
+        else:
+            positional.append(arg)
+        index += 1
+    return positional, flags
+
+
+def render_manifest(release_name, chart_name, values):
+    """
+    Args:
+        release_name (str): release name
+        chart_name (str): chart name
+        values (dict): release values
+    Returns:
+        str - manifest of about FAKE_HELM_MANIFEST_SIZE bytes
+    """
+    documents = []
+    size = 0
+    index = 0
+    values_line = json.dumps(json.dumps(values, sort_keys=True))
+    while size < MANIFEST_SIZE or index == 0:
+        document = ('---\n# Source: {0}/templates/cm-{1}.yaml\napiVersion: v1\nkind: ConfigMap\nmetadata:\n'
+                    '  name: {2}-{1}\ndata:\n  values: {3}\n  padding: "{4}"\n').format(
+            chart_name, index, release_name, values_line, 'x' * 900)
+        documents.append(document)
+        size += len(document)
+        index += 1
+    return ''.join(documents)
+
+
+def read_values(flags):
+    """
+    Args:
+        flags (dict): parsed flags
+    Returns:
+        dict - values passed with -f
+    """
+    values_file = flags.get('-f') or flags.get('--values')
+    if not values_file:
+        return {}
+    content = sys.stdin.read() if values_file == '-' else open(values_file).read()
+    try:
+        return json.loads(content) or {}
+    except ValueError:
+        import yaml
+        return yaml.safe_load(content) or {}
+
+
+def write_repository_config(repos):
+    """
+    Args:
+        repos (list): repo dicts with name and url
+    """
+    lines = ['apiVersion: ""', 'generated: "0001-01-01T00:00:00Z"', 'repositories:']
+    for repo in repos:
+        lines += ['- caFile: ""', '  certFile: ""', '  insecure_skip_tls_verify: false', '  keyFile: ""',
+                  '  name: {0}'.format(repo['name']), '  pass_credentials_all: false', '  password: ""',
+                  '  url: {0}'.format(repo['url']), '  username: ""']
+    with open(REPOSITORY_CONFIG, 'w') as config_file:
+        config_file.write('\n'.join(lines) + '\n')
+
+
+def write_repository_index(repo_name, repo_url):
+    """
+    Args:
+        repo_name (str): repo name
+        repo_url (str): repo URL
+    """
+    if not os.path.isdir(REPOSITORY_CACHE):
+        os.makedirs(REPOSITORY_CACHE)
+
+    charts = INDEX_CHARTS + ['filler{0}'.format(index) for index in range(INDEX_SIZE)]
+    with open(os.path.join(REPOSITORY_CACHE, '{0}-index.yaml'.format(repo_name)), 'w') as index_file:
+        index_file.write('apiVersion: v1\nentries:\n')
+        for chart in charts:
+            index_file.write('  {0}:\n'.format(chart))
+            for version in reversed(INDEX_VERSIONS):
+                index_file.write(
+                    '  - apiVersion: v2\n    appVersion: 1.0.0\n    created: "2020-01-01T00:00:00Z"\n'
+                    '    description: {0} chart\n    digest: {1}\n    name: {0}\n    urls:\n'
+                    '    - {2}/{0}-{3}.tgz\n    version: {3}\n'.format(
+                        chart, hashlib.sha256('{0}-{1}'.format(chart, version).encode('utf-8')).hexdigest(),
+                        repo_url.rstrip('/'), version))
+        index_file.write('generated: "2020-01-01T00:00:00Z"\n')
+
+
+def get_chart_metadata(chart):
+    """
+    Args:
+        chart (str): chart reference, path to directory or package
+    Returns:
+        str - chart name
+        str - chart version, None if it's not read from Chart.yaml
+    """
+    # Like helm, local chart is identified by its Chart.yaml, not by file name
+    chart_yaml = None
+    if os.path.isdir(chart) and os.path.isfile(os.path.join(chart, 'Chart.yaml')):
+        with open(os.path.join(chart, 'Chart.yaml')) as chart_file:
+            chart_yaml = chart_file.read()
+    elif os.path.isfile(chart) and tarfile.is_tarfile(chart):
+        with tarfile.open(chart, 'r:gz') as chart_archive:
+            for member in chart_archive.getmembers():
+                if member.name.count('/') == 1 and member.name.endswith('/Chart.yaml'):
+                    chart_yaml = chart_archive.extractfile(member).read().decode('utf-8')
+                    break
+
+    if chart_yaml is None:
+        return os.path.basename(chart.rstrip('/')), None
+    metadata = {}
+    for line in chart_yaml.splitlines():
+        if ':' in line and not line[0].isspace():
+            key, value = line.split(':', 1)
+            metadata[key.strip()] = value.strip().strip('"\'')
+    return metadata.get('name'), metadata.get('version')
+
+
+def release_entry(release):
+    return {'name': release['name'], 'namespace': release['namespace'], 'revision': str(release['revision']),
+            'updated': '2020-01-01 00:00:00.000000000 +0000 UTC', 'status': release['status'],
+            'chart': '{0}-{1}'.format(release['chart'], release['version']), 'app_version': '1.0.0'}
+
+
+def main(argv):
+    if not os.path.isdir(STATE_DIR):
+        os.makedirs(STATE_DIR)
+
+    # Latency is simulated before lock, so parallel calls are not serialized by the fake
+    time.sleep(LATENCY)
+
+    # Parallel calls change the same state file
+    lock = open(os.path.join(STATE_DIR, 'lock'), 'w')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+
+    with open(os.path.join(STATE_DIR, 'calls.log'), 'a') as calls_log:
+        calls_log.write(json.dumps(argv) + '\n')
+
+    positional, flags = parse_args(argv)
+    namespace = flags.get('-n') or flags.get('--namespace') or 'default'
+    command = positional[:2] if positional[0] in ['repo', 'get'] else positional[:1]
+    args = positional[len(command):]
+
+    # Every kube context is a separate cluster with its own releases
+    kube_context = flags.get('--kube-context')
+    state_path = os.path.join(STATE_DIR, 'state-{0}.json'.format(kube_context) if kube_context else 'state.json')
+    state = {'releases': {}, 'repos': []}
+    if os.path.exists(state_path):
+        with open(state_path) as state_file:
+            state = json.load(state_file)
+
+    def save_state():
+        with open(state_path, 'w') as state_file:
+            json.dump(state, state_file)
+
+    def fail(message, code=1):
+        sys.stderr.write('Error: {0}\n'.format(message))
+        return code
+
+    if kube_context in FAIL_CONTEXTS and positional[0] not in ['env', 'repo', 'template']:
+        return fail('Kubernetes cluster unreachable: context "{0}"'.format(kube_context))
+    elif command == ['env']:
+        print('HELM_REPOSITORY_CONFIG="{0}"\nHELM_REPOSITORY_CACHE="{1}"'.format(REPOSITORY_CONFIG, REPOSITORY_CACHE))
+    elif command == ['repo', 'list']:
+        if not state['repos']:
+            return fail('no repositories to show')
+        print(json.dumps(state['repos']))
+    elif command == ['repo', 'add']:
+        state['repos'] = [repo for repo in state['repos'] if repo['name'] != args[0]]
+        state['repos'].append({'name': args[0], 'url': args[1]})
+        save_state()
+        write_repository_config(state['repos'])
+        write_repository_index(args[0], args[1])
+        print('"{0}" has been added to your repositories'.format(args[0]))
+    elif command == ['repo', 'update']:
+        time.sleep(UPDATE_LATENCY * max(1, len(args) or len(state['repos'])))
+        for repo in state['repos']:
+            if not args or repo['name'] in args:
+                write_repository_index(repo['name'], repo['url'])
+        print('Hang tight while we grab the latest from your chart repositories...')
+        print('Update Complete. ⎈Happy Helming!⎈')
+    elif command == ['list']:
+        releases = [release_entry(release) for release in state['releases'].values()
+                    if '-A' in flags or '--all-namespaces' in flags or release['namespace'] == namespace]
+        print(json.dumps(releases))
+    elif command == ['status']:
+        release = state['releases'].get('{0}/{1}'.format(namespace, args[0]))
+        if release is None:
+            return fail('release: not found')
+        print(json.dumps({'name': release['name'], 'namespace': release['namespace'], 'version': release['revision'],
+                          'info': {'status': release['status']},
+                          'chart': {'metadata': {'name': release['chart'], 'version': release['version'],
+                                                 'appVersion': '1.0.0'}},
+                          'config': release['config']}))
+    elif command == ['get', 'values']:
+        release = state['releases'].get('{0}/{1}'.format(namespace, args[0]))
+        if release is None:
+            return fail('release: not found')
+        print(json.dumps(release['config'] or None))
+    elif command == ['get', 'manifest']:
+        release = state['releases'].get('{0}/{1}'.format(namespace, args[0]))
+        if release is None:
+            return fail('release: not found')
+        sys.stdout.write(render_manifest(release['name'], release['chart'], release['config']))
+    elif command == ['template']:
+        sys.stdout.write(render_manifest(args[0], get_chart_metadata(args[1])[0], read_values(flags)))
+    elif command in [['install'], ['upgrade']]:
+        release_name = args[0]
+        (chart_name, chart_version) = get_chart_metadata(args[1])
+        values = read_values(flags)
+        release_key = '{0}/{1}'.format(namespace, release_name)
+        deployed = state['releases'].get(release_key)
+        if release_name in FAIL_RELEASES:
+            return fail('{0} FAILED: context deadline exceeded'.format(command[0].upper()))
+        if command == ['install'] and deployed is not None and '--replace' not in flags:
+            return fail('INSTALLATION FAILED: cannot re-use a name that is still in use')
+        revision = deployed['revision'] + 1 if deployed else 1
+        release = {'name': release_name, 'namespace': namespace, 'revision': revision,
+                   'status': 'deployed', 'chart': chart_name,
+                   'version': chart_version or flags.get('--version', '1.0.0'),
+                   'config': values}
+        if '--dry-run' not in flags:
+            state['releases'][release_key] = release
+            save_state()
+        print(json.dumps({'name': release_name, 'namespace': namespace, 'version': release['revision'],
+                          'manifest': render_manifest(release_name, chart_name, values), 'config': values,
+                          'chart': {'metadata': {'name': chart_name, 'version': release['version']}},
+                          'info': {'status': 'pending-upgrade' if '--dry-run' in flags else 'deployed',
+                                   'notes': 'Thank you for installing {0}.'.format(chart_name)}}))
+    elif command in [['delete'], ['uninstall']]:
+        release_key = '{0}/{1}'.format(namespace, args[0])
+        if release_key not in state['releases']:
+            return fail('uninstall: Release not loaded: {0}: release: not found'.format(args[0]))
+        if '--dry-run' not in flags:
+            del state['releases'][release_key]
+            save_state()
+        print('release "{0}" uninstalled'.format(args[0]))
+    else:
+        return fail('unknown command "{0}"'.format(' '.join(positional)), 2)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
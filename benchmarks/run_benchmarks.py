@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+"""
+Offline benchmarks for helm_shell.
+
+Every scenario runs against benchmarks/fake_helm.py put on PATH as `helm`, so no cluster is needed.
+Scenarios with mode 'module' run plugins/modules/helm_shell.py directly, scenarios with mode 'action'
+run a playbook through the ActionModule.run() path with local connection.
+
+Usage:
+    python benchmarks/run_benchmarks.py [--scenario NAME] [--runs N] [--json FILE]
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGINS_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'plugins')
+
+REPO_SOURCE = {'type': 'repo', 'name': 'bench', 'location': 'https://charts.example.com', 'username': '',
+               'password': ''}
+LOCAL_SOURCE = {'type': 'local', 'location': 'bench-1.0.0.tgz'}
+LOCAL_DIR_SOURCE = {'type': 'local', 'location': 'bench'}
+
+SCENARIOS = [
+    dict(name='repo_install', mode='module', cold_cache=True,
+         args=dict(name='memcached', chart_deploy_name='cache', version='1.0.0', source=REPO_SOURCE)),
+    dict(name='repo_upgrade_unchanged', mode='module', deploy_first=True,
+         args=dict(name='memcached', chart_deploy_name='cache', version='1.0.0', source=REPO_SOURCE)),
+    dict(name='repo_update_slow', mode='module', cold_cache=True, env=dict(FAKE_HELM_UPDATE_LATENCY='0.5'),
+         args=dict(name='memcached', chart_deploy_name='cache', version='1.0.0', source=REPO_SOURCE)),
+    dict(name='large_namespace_large_manifest', mode='module', seed_releases=500, cold_cache=True,
+         env=dict(FAKE_HELM_MANIFEST_SIZE=str(5 * 1024 * 1024)),
+         args=dict(name='prometheus', chart_deploy_name='prometheus', version='1.0.0', source=REPO_SOURCE,
+                   skip_unchanged=False)),
+    dict(name='batch_20_releases', mode='module', cold_cache=True, env=dict(FAKE_HELM_LATENCY='0.05'),
+         args=dict(max_workers=8, releases=[dict(name='chart{0}'.format(index), version='1.0.0', source=REPO_SOURCE,
+                                                 chart_deploy_name='rel{0}'.format(index)) for index in range(20)])),
+    dict(name='dag_20_releases', mode='module', cold_cache=True, env=dict(FAKE_HELM_LATENCY='0.05'),
+         args=dict(max_workers=8, releases=[dict(name='chart{0}'.format(index), version='1.0.0', source=REPO_SOURCE,
+                                                 chart_deploy_name='rel{0}'.format(index),
+                                                 depends_on=['rel{0}'.format(index // 4 - 1)] if index >= 4 else [])
+                                            for index in range(20)])),
+    dict(name='fanout_10_contexts', mode='module', cold_cache=True, env=dict(FAKE_HELM_LATENCY='0.05'),
+         args=dict(name='memcached', chart_deploy_name='cache', version='1.0.0', source=REPO_SOURCE, max_workers=10,
+                   kube_contexts=[dict(name='cluster{0}'.format(index)) for index in range(10)])),
+    dict(name='resolve_constraint_large_index', mode='module', deploy_first=True,
+         env=dict(FAKE_HELM_INDEX_SIZE='5000', FAKE_HELM_UPDATE_LATENCY='0.5'),
+         args=dict(name='memcached', chart_deploy_name='cache', version='~1.0', source=REPO_SOURCE)),
+    dict(name='action_repo_values', mode='action',
+         args=dict(name='memcached', chart_deploy_name='cache', version='1.0.0', source=REPO_SOURCE,
+                   values={'replicaCount': 2}, values_file='bench-values.yaml')),
+    dict(name='action_local_chart', mode='action',
+         args=dict(name='bench', chart_deploy_name='bench', version='1.0.0', source=LOCAL_SOURCE,
+                   values={'replicaCount': 2})),
+    dict(name='action_local_chart_dir_changed', mode='action', change_chart=True,
+         args=dict(name='bench', chart_deploy_name='bench', version='1.0.0', source=LOCAL_DIR_SOURCE,
+                   values={'replicaCount': 2})),
+    dict(name='action_local_chart_dir_same_version', mode='action', deploy_first=True, change_chart=True,
+         expect_changed=True,
+         args=dict(name='bench', chart_deploy_name='bench', version='1.0.0', source=LOCAL_DIR_SOURCE,
+                   values={'replicaCount': 2})),
+    dict(name='action_check_rendered', mode='action', deploy_first=True, check_mode=True,
+         args=dict(name='memcached', chart_deploy_name='cache', version='1.0.0', source=REPO_SOURCE,
+                   values={'replicaCount': 2}, values_file='bench-values.yaml', render='controller')),
+]
+
+
+def create_workspace():
+    """
+    Returns:
+        str - path to benchmark workspace with `helm` on bin path
+    """
+    workspace = tempfile.mkdtemp(prefix='helm_shell_bench_')
+    bin_dir = os.path.join(workspace, 'bin')
+    files_dir = os.path.join(workspace, 'files')
+    os.makedirs(bin_dir)
+    os.makedirs(files_dir)
+
+    # Stub helm binary
+    helm_path = os.path.join(bin_dir, 'helm')
+    with open(helm_path, 'w') as helm_file:
+        helm_file.write('#!/bin/sh\nexec "{0}" "{1}" "$@"\n'.format(sys.executable,
+                                                                     os.path.join(BENCHMARKS_DIR, 'fake_helm.py')))
+    os.chmod(helm_path, 0o755)
+
+    # Chart and values files for action scenarios
+    chart_dir = os.path.join(workspace, 'chart', 'bench')
+    os.makedirs(os.path.join(chart_dir, 'templates'))
+    with open(os.path.join(chart_dir, 'Chart.yaml'), 'w') as chart_file:
+        chart_file.write('apiVersion: v2\nname: bench\nversion: 1.0.0\n')
+    with open(os.path.join(chart_dir, 'templates', 'cm.yaml'), 'w') as template_file:
+        template_file.write('apiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: {{ .Release.Name }}\n'
+                            'data:\n  padding: "' + 'x' * 1024 * 1024 + '"\n')
+    with tarfile.open(os.path.join(files_dir, 'bench-1.0.0.tgz'), 'w:gz') as chart_archive:
+        chart_archive.add(chart_dir, arcname='bench')
+    shutil.copytree(chart_dir, os.path.join(files_dir, 'bench'))
+    with open(os.path.join(files_dir, 'bench-values.yaml'), 'w') as values_file:
+        values_file.write('resources:\n  limits:\n    cpu: 100m\nitems:\n' +
+                          ''.join('  - item{0}\n'.format(index) for index in range(2000)))
+
+    with open(os.path.join(workspace, 'ansible.cfg'), 'w') as config_file:
+        config_file.write('[defaults]\naction_plugins = {0}\nlibrary = {1}\ninterpreter_python = {2}\n'
+                          'host_key_checking = False\nretry_files_enabled = False\n'.format(
+                              os.path.join(PLUGINS_DIR, 'action'), os.path.join(PLUGINS_DIR, 'modules'),
+                              sys.executable))
+    return workspace
+
+
+def seed_state(state_dir, seed_releases):
+    """
+    Args:
+        state_dir (str): fake helm state directory
+        seed_releases (int): number of unrelated releases in default namespace
+    """
+    if os.path.isdir(state_dir):
+        shutil.rmtree(state_dir)
+    os.makedirs(state_dir)
+
+    releases = {}
+    for index in range(seed_releases):
+        releases['default/seed{0}'.format(index)] = {
+            'name': 'seed{0}'.format(index), 'namespace': 'default', 'revision': 1, 'status': 'deployed',
+            'chart': 'seed', 'version': '1.0.0', 'config': {}}
+    with open(os.path.join(state_dir, 'state.json'), 'w') as state_file:
+        json.dump({'releases': releases, 'repos': []}, state_file)
+
+
+def count_calls(state_dir):
+    calls_path = os.path.join(state_dir, 'calls.log')
+    if not os.path.exists(calls_path):
+        return 0
+    with open(calls_path) as calls_log:
+        return sum(1 for _ in calls_log)
+
+
+def run_measured(cmd, env, cwd):
+    """
+    Args:
+        cmd (list): command to run
+        env (dict): process environment
+        cwd (str): working directory
+    Returns:
+        float - wall-clock seconds
+        int - peak RSS of process tree in KB
+        int - return code
+        str - stdout
+    """
+    start_time = time.time()
+    with tempfile.TemporaryFile() as output:
+        process = subprocess.Popen(cmd, env=env, cwd=cwd, stdout=output, stderr=subprocess.STDOUT)
+        # wait4 reports max RSS of process and its waited children
+        (_, status, rusage) = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        duration = time.time() - start_time
+        output.seek(0)
+        return duration, rusage.ru_maxrss, process.returncode, output.read().decode('utf-8', 'replace')
+
+
+def module_command(workspace, args, run_index):
+    args_path = os.path.join(workspace, 'args-{0}.json'.format(run_index))
+    with open(args_path, 'w') as args_file:
+        json.dump({'ANSIBLE_MODULE_ARGS': args}, args_file)
+    return [sys.executable, os.path.join(PLUGINS_DIR, 'modules', 'helm_shell.py'), args_path]
+
+
+def action_command(workspace, args, tasks, check_mode=False):
+    playbook_path = os.path.join(workspace, 'playbook-{0}.json'.format(tasks))
+    with open(playbook_path, 'w') as playbook_file:
+        json.dump([{'hosts': 'localhost', 'gather_facts': False,
+                    'tasks': [{'helm_shell': args} for _ in range(tasks)]}], playbook_file)
+    return ['ansible-playbook', '-i', 'localhost,', '-c', 'local', playbook_path] + (['--check'] if check_mode else [])
+
+
+def write_run_template(workspace, run_index):
+    with open(os.path.join(workspace, 'files', 'bench', 'templates', 'run.yaml'), 'w') as template_file:
+        template_file.write('# run {0}\n'.format(run_index))
+
+
+def run_scenario(workspace, scenario, runs):
+    """
+    Args:
+        workspace (str): benchmark workspace
+        scenario (dict): scenario from SCENARIOS
+        runs (int): number of measured runs
+    Returns:
+        dict - scenario results
+    """
+    state_dir = os.path.join(workspace, 'state')
+    cache_dir = os.path.join(workspace, 'cache')
+    seed_state(state_dir, scenario.get('seed_releases', 0))
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+
+    env = dict(os.environ)
+    env.update(scenario.get('env', {}))
+    env.update({'PATH': os.path.join(workspace, 'bin') + os.pathsep + env.get('PATH', ''), 'FAKE_HELM_STATE': state_dir,
+                'HELM_REPOSITORY_CONFIG': os.path.join(state_dir, 'repositories.yaml'),
+                'HELM_REPOSITORY_CACHE': os.path.join(state_dir, 'repository'),
+                'ANSIBLE_CONFIG': os.path.join(workspace, 'ansible.cfg')})
+
+    args = dict(scenario['args'])
+    args.update({'cache_dir': cache_dir, 'chart_cache_dir': os.path.join(cache_dir, 'charts')})
+    if args.get('render') == 'controller':
+        args['render_cache_dir'] = os.path.join(cache_dir, 'renders')
+
+    # Release is deployed with run index -1, only measured runs use check mode
+    if scenario['mode'] == 'module':
+        run_command = lambda run_index: module_command(workspace, args, run_index)
+    else:
+        run_command = lambda run_index: action_command(workspace, args, 1,
+                                                       scenario.get('check_mode') and run_index >= 0)
+
+    if scenario.get('deploy_first'):
+        if scenario.get('change_chart'):
+            write_run_template(workspace, -1)
+        run_measured(run_command(-1), env, os.path.join(workspace, 'files'))
+
+    # Playbook startup is measured separately and excluded from task latency
+    startup = 0.0
+    if scenario['mode'] == 'action':
+        startup = run_measured(action_command(workspace, args, 0), env, os.path.join(workspace, 'files'))[0]
+
+    latencies, calls, peak_memory, failures = [], [], [], 0
+    for run_index in range(runs):
+        if scenario.get('cold_cache') and os.path.isdir(cache_dir):
+            shutil.rmtree(cache_dir)
+        # One small template is changed before every run, the rest of chart directory is the same
+        if scenario.get('change_chart'):
+            write_run_template(workspace, run_index)
+        calls_before = count_calls(state_dir)
+        (duration, max_rss, return_code, output) = run_measured(run_command(run_index), env,
+                                                                os.path.join(workspace, 'files'))
+        if return_code or '"failed": true' in output:
+            failures += 1
+        # Template changed without version bump must upgrade release
+        elif scenario.get('expect_changed') and 'changed: [localhost]' not in output:
+            failures += 1
+        latencies.append(max(duration - startup, 0.0))
+        calls.append(count_calls(state_dir) - calls_before)
+        peak_memory.append(max_rss)
+
+    latencies.sort()
+    return {'scenario': scenario['name'], 'mode': scenario['mode'], 'runs': runs, 'failures': failures,
+            'latency_min': round(latencies[0], 4), 'latency_median': round(latencies[len(latencies) // 2], 4),
+            'latency_max': round(latencies[-1], 4), 'helm_calls': round(float(sum(calls)) / runs, 2),
+            'peak_memory_kb': max(peak_memory)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for helm_shell')
+    parser.add_argument('--scenario', action='append', help='run only this scenario, can be repeated')
+    parser.add_argument('--runs', type=int, default=5, help='measured runs per scenario')
+    parser.add_argument('--json', help='save results to JSON file')
+    parser.add_argument('--keep-workspace', action='store_true', help='do not remove benchmark workspace')
+    options = parser.parse_args()
+
+    scenarios = [scenario for scenario in SCENARIOS if not options.scenario or scenario['name'] in options.scenario]
+    workspace = create_workspace()
+    results = []
+    try:
+        header = '{0:<32} {1:<7} {2:>9} {3:>9} {4:>9} {5:>10} {6:>12} {7:>8}'
+        print(header.format('scenario', 'mode', 'min s', 'median s', 'max s', 'helm calls', 'peak rss KB',
+                            'failures'))
+        for scenario in scenarios:
+            scenario_result = run_scenario(workspace, scenario, options.runs)
+            results.append(scenario_result)
+            print(header.format(scenario_result['scenario'], scenario_result['mode'], scenario_result['latency_min'],
+                                scenario_result['latency_median'], scenario_result['latency_max'],
+                                scenario_result['helm_calls'], scenario_result['peak_memory_kb'],
+                                scenario_result['failures']))
+    finally:
+        if options.keep_workspace:
+            print('Workspace: {0}'.format(workspace))
+        else:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    if options.json:
+        with open(options.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+    return 1 if any(scenario_result['failures'] for scenario_result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,15 +4,34 @@ from __future__ import (absolute_import, division, print_function)
 
 __metaclass__ = type
 
+import fnmatch
+import hashlib
+import io
 import json
 import os
+import pickle
+import re
+import subprocess
+import tarfile
 import tempfile
+import time
 
 import yaml
 from ansible import constants as _const
 from ansible.module_utils.common.json import AnsibleJSONEncoder
+from ansible.module_utils.six.moves import shlex_quote
 from ansible.plugins.action import ActionBase
-from jsonmerge import merge
+from ansible.utils.display import Display
+
+display = Display()
+
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Only chart of exact version is rendered from repo, other versions can change between runs
+EXACT_VERSION_RE = re.compile(r'^v?\d+\.\d+\.\d+(-[0-9A-Za-z.-]+)?(\+[0-9A-Za-z.-]+)?$')
+
+# Parsed values files and merged values used by this worker process
+values_cache = {}
 
 
 class ActionModule(ActionBase):
@@ -21,16 +40,13 @@ class ActionModule(ActionBase):
     def create_content_tempfile(content):
         result = {'failed': False, 'message': 'None', 'reason': 'None', 'content': 'None'}
 
-        # Convert AnsibleUnsafeText to normal JSON
-        content = json.dumps(content, sort_keys=True, cls=AnsibleJSONEncoder)
-        content = json.loads(content)
-
         # Create a tempfile containing defined content
-        tmp_file_dir, content_tempfile = tempfile.mkstemp(dir=_const.DEFAULT_LOCAL_TMP)
+        tmp_file_fd, content_tempfile = tempfile.mkstemp(dir=_const.DEFAULT_LOCAL_TMP)
 
+        # JSON is valid YAML for helm, values are serialized only once
         try:
-            with open(content_tempfile, 'w') as yml:
-                yaml.safe_dump(content, yml, default_flow_style=False)
+            with os.fdopen(tmp_file_fd, 'w') as yml:
+                json.dump(content, yml, sort_keys=True, cls=AnsibleJSONEncoder)
         except Exception as err:
             result['failed'] = True
             result['content'] = content
@@ -40,6 +56,21 @@ class ActionModule(ActionBase):
 
         return result, content_tempfile
 
+    @staticmethod
+    def get_values_digest(values):
+        # Must produce the same digest as helm_shell module for 'helm get values' output
+        def canonical(value):
+            if isinstance(value, dict):
+                return dict((str(key), canonical(item)) for key, item in value.items())
+            if isinstance(value, list):
+                return [canonical(item) for item in value]
+            if isinstance(value, float) and value.is_integer():
+                return int(value)
+            return value
+
+        content = json.dumps(canonical(values or {}), sort_keys=True, separators=(',', ':'), cls=AnsibleJSONEncoder)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
     def create_remote_tmp_dir(self):
         result = {'failed': False, 'message': 'None', 'reason': 'None'}
 
@@ -54,23 +85,180 @@ class ActionModule(ActionBase):
 
         return result, tmp_dst_dir
 
-    def upload_helm_chart(self, chart_file_name, remote_tmp_dir):
-        result = {'failed': False, 'message': 'None', 'reason': 'None'}
+    def record_timing(self, phase, start_time, calls=0, output_bytes=0):
+        phase_timing = self._timings.setdefault(phase, {'time': 0.0, 'calls': 0, 'output_bytes': 0})
+        phase_timing['time'] = round(phase_timing['time'] + time.time() - start_time, 6)
+        phase_timing['calls'] += calls
+        phase_timing['output_bytes'] += output_bytes
 
-        remote_chart_path = os.path.join(remote_tmp_dir, chart_file_name)
+    @staticmethod
+    def get_file_digest(file_path):
+        file_digest = hashlib.sha256()
+        with open(file_path, 'rb') as _file:
+            for chunk in iter(lambda: _file.read(1024 * 1024), b''):
+                file_digest.update(chunk)
+        return file_digest.hexdigest()
+
+    @staticmethod
+    def get_chart_files(chart_dir):
+        ignore_patterns = []
+        helmignore_path = os.path.join(chart_dir, '.helmignore')
+        if os.path.isfile(helmignore_path):
+            with open(helmignore_path, 'r') as _file:
+                ignore_patterns = [line.strip() for line in _file if line.strip() and not line.startswith('#')]
+
+        def is_ignored(relative_path, is_dir):
+            for pattern in ignore_patterns:
+                if pattern.endswith('/'):
+                    if not is_dir:
+                        continue
+                    pattern = pattern.rstrip('/')
+                if fnmatch.fnmatch(relative_path, pattern) or fnmatch.fnmatch(os.path.basename(relative_path),
+                                                                              pattern):
+                    return True
+            return False
+
+        # Files are sorted and only path, mode and content are used, so same content gives same chart digest
+        chart_files = []
+        for root, dirs, files in os.walk(chart_dir):
+            relative_root = os.path.relpath(root, chart_dir)
+            dirs[:] = [_dir for _dir in dirs if not is_ignored(os.path.normpath(os.path.join(relative_root, _dir)),
+                                                               True)]
+            for file_name in files:
+                relative_path = os.path.normpath(os.path.join(relative_root, file_name))
+                if is_ignored(relative_path, False):
+                    continue
+                file_path = os.path.join(root, file_name)
+                file_mode = 0o755 if os.stat(file_path).st_mode & 0o100 else 0o644
+                chart_files.append((relative_path.replace(os.sep, '/'), file_mode,
+                                    ActionModule.get_file_digest(file_path), file_path))
+
+        return sorted(chart_files)
+
+    def upload_chart_directory(self, chart_dir, remote_tmp_dir, remote_cache_dir):
+        result = {'failed': False, 'message': 'None', 'reason': 'None', 'chart_cache_hit': False, 'calls': 1,
+                  'output_bytes': 0}
+
+        # Archive entries are prefixed with chart name like in 'helm package'
+        try:
+            with open(os.path.join(chart_dir, 'Chart.yaml'), 'r') as _file:
+                chart_name = (yaml.load(_file, Loader=YamlLoader) or {}).get('name')
+        except Exception as err:
+            result['failed'] = True
+            result['message'] = 'Can\'t read Chart.yaml of chart directory {0}'.format(chart_dir)
+            result['reason'] = str(err)
+            return result, ''
+        chart_name = chart_name or os.path.basename(os.path.normpath(chart_dir))
+        chart_files = self.get_chart_files(chart_dir)
+        result['chart_files'] = [['{0}/{1}'.format(chart_name, relative_path), file_mode, file_digest]
+                                 for relative_path, file_mode, file_digest, _ in chart_files]
+
+        # Chart is packaged on remote host from file blobs, packaged charts are cached by digest of file list
+        chart_digest = hashlib.sha256(json.dumps(result['chart_files'], separators=(',', ':')).encode('utf-8'))
+        remote_chart_path = os.path.join(remote_cache_dir, chart_digest.hexdigest() + '.tgz')
+        cache_check = self._low_level_execute_command('test -f {0} && touch {0}'.format(shlex_quote(remote_chart_path)),
+                                                      sudoable=False)
+        if cache_check['rc'] == 0:
+            result['chart_cache_hit'] = True
+            return result, remote_chart_path
+
+        # Find blobs which are not on remote host yet, touch existing ones to keep them in cache
+        remote_blobs_dir = os.path.join(remote_cache_dir, 'blobs')
+        local_blobs = dict((file_digest, file_path) for _, _, file_digest, file_path in chart_files)
+        blobs_check = self._low_level_execute_command(
+            'mkdir -p {0} && cd {0} && for blob in {1}; do test -f $blob && touch $blob || echo $blob; done'.format(
+                shlex_quote(remote_blobs_dir), ' '.join(sorted(local_blobs))), sudoable=False)
+        result['calls'] += 1
+        if blobs_check['rc'] != 0:
+            result['failed'] = True
+            result['message'] = 'Can\'t check chart files in cache on remote server'
+            result['reason'] = blobs_check['stderr']
+            return result, ''
+
+        missing_blobs = [blob for blob in blobs_check['stdout'].split() if blob in local_blobs]
+        if not missing_blobs:
+            return result, remote_chart_path
+
+        # Only changed files are packed, archive is written as stream
+        tmp_file_fd, delta_path = tempfile.mkstemp(dir=_const.DEFAULT_LOCAL_TMP, suffix='.tgz')
+        try:
+            with os.fdopen(tmp_file_fd, 'wb') as _file:
+                with tarfile.open(fileobj=_file, mode='w|gz') as delta:
+                    for blob in missing_blobs:
+                        blob_info = tarfile.TarInfo(blob)
+                        blob_info.size = os.path.getsize(local_blobs[blob])
+                        with open(local_blobs[blob], 'rb') as blob_file:
+                            delta.addfile(blob_info, blob_file)
+            result['output_bytes'] = os.path.getsize(delta_path)
+
+            remote_delta_path = os.path.join(remote_tmp_dir, os.path.basename(delta_path))
+            self._connection.put_file(delta_path, remote_delta_path)
+        except Exception as err:
+            result['failed'] = True
+            result['message'] = 'Can\'t upload helm chart files from localhost to remote server'
+            result['reason'] = err
+            return result, ''
+        finally:
+            os.remove(delta_path)
+
+        # Blobs are unpacked aside and moved in place, parallel tasks never see half-written blob
+        blobs_save = self._low_level_execute_command(
+            'tmp_dir=$(mktemp -d {0}) && tar -xzf {1} -C "$tmp_dir" && mv -f "$tmp_dir"/* {2}/; rc=$?; '
+            'rm -rf "$tmp_dir" {1}; exit $rc'.format(
+                shlex_quote(os.path.join(remote_cache_dir, 'blobs-tmp.XXXXXX')), shlex_quote(remote_delta_path),
+                shlex_quote(remote_blobs_dir)), sudoable=False)
+        result['calls'] += 2
+        if blobs_save['rc'] != 0:
+            result['failed'] = True
+            result['message'] = 'Can\'t save helm chart files to cache on remote server'
+            result['reason'] = blobs_save['stderr']
+            return result, ''
+
+        return result, remote_chart_path
+
+    def upload_helm_chart(self, chart_file_name, remote_tmp_dir, remote_cache_dir):
+        result = {'failed': False, 'message': 'None', 'reason': 'None', 'chart_cache_hit': False, 'calls': 1,
+                  'output_bytes': 0}
 
         # Find the source value file
         local_chart_path = self._find_needle('files', chart_file_name)
 
-        # Copy file from localhost to remote host
+        # Chart directory is uploaded file by file
+        if os.path.isdir(local_chart_path):
+            return self.upload_chart_directory(local_chart_path, remote_tmp_dir, remote_cache_dir)
+
+        # Charts are stored in remote cache by content digest
+        remote_chart_path = os.path.join(remote_cache_dir, self.get_file_digest(local_chart_path) + '.tgz')
+
+        # Use cached chart, touch it to keep it in cache
+        cache_check = self._low_level_execute_command('test -f {0} && touch {0}'.format(shlex_quote(remote_chart_path)),
+                                                      sudoable=False)
+        if cache_check['rc'] == 0:
+            result['chart_cache_hit'] = True
+            return result, remote_chart_path
+
+        remote_tmp_chart_path = os.path.join(remote_tmp_dir, os.path.basename(remote_chart_path))
+        result['calls'] += 2
+        result['output_bytes'] = os.path.getsize(local_chart_path)
+
+        # Copy file from localhost to remote host and move it to cache when upload is finished
         try:
-            self._connection.put_file(local_chart_path, remote_chart_path)
+            self._connection.put_file(local_chart_path, remote_tmp_chart_path)
         except Exception as err:
             result['failed'] = True
             result['message'] = 'Can\'t upload helm chart from localhost to remote server'
             result['reason'] = err
             return result, ''
 
+        cache_save = self._low_level_execute_command('mkdir -p {0} && mv {1} {2}'.format(
+            shlex_quote(remote_cache_dir), shlex_quote(remote_tmp_chart_path), shlex_quote(remote_chart_path)),
+            sudoable=False)
+        if cache_save['rc'] != 0:
+            result['failed'] = True
+            result['message'] = 'Can\'t save helm chart to cache on remote server'
+            result['reason'] = cache_save['stderr']
+            return result, ''
+
         return result, remote_chart_path
 
     def upload_values_file(self, value_file_content, remote_tmp_dir):
@@ -95,82 +283,411 @@ class ActionModule(ActionBase):
 
         return result, remote_values_file, content_temp_file
 
+    def upload_manifest_file(self, manifest, remote_tmp_dir):
+        result = {'failed': False, 'message': 'None', 'reason': 'None'}
+
+        # Manifest can contain rendered secrets, it's passed as file instead of module args echoed in results and logs
+        tmp_file_fd, content_temp_file = tempfile.mkstemp(dir=_const.DEFAULT_LOCAL_TMP)
+        remote_manifest_file = os.path.join(remote_tmp_dir, os.path.basename(content_temp_file) + '.yaml')
+        try:
+            with os.fdopen(tmp_file_fd, 'w') as _file:
+                _file.write(manifest)
+            self._connection.put_file(content_temp_file, remote_manifest_file)
+        except Exception as err:
+            result['failed'] = True
+            result['message'] = 'Can\'t upload rendered manifest from localhost to remote server'
+            result['reason'] = err
+            return result, '', content_temp_file
+
+        return result, remote_manifest_file, content_temp_file
+
+    @staticmethod
+    def read_values_cache(cache_key):
+        if cache_key in values_cache:
+            return values_cache[cache_key]
+
+        # Values parsed by other tasks of this playbook run
+        try:
+            with open(os.path.join(_const.DEFAULT_LOCAL_TMP, 'helm_shell_{0}.pickle'.format(cache_key)), 'rb') as _file:
+                values_cache[cache_key] = pickle.load(_file)
+        except Exception:
+            return None
+
+        return values_cache[cache_key]
+
+    @staticmethod
+    def save_values_cache(cache_key, content):
+        values_cache[cache_key] = content
+
+        # Local tmp dir is shared by all workers of playbook run and removed at the end of it
+        try:
+            tmp_file_fd, tmp_file_path = tempfile.mkstemp(dir=_const.DEFAULT_LOCAL_TMP)
+            with os.fdopen(tmp_file_fd, 'wb') as _file:
+                pickle.dump(content, _file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_file_path, os.path.join(_const.DEFAULT_LOCAL_TMP, 'helm_shell_{0}.pickle'.format(cache_key)))
+        except Exception:
+            pass
+
+    @staticmethod
+    def deep_merge(base, head):
+        # Same result as jsonmerge.merge with default schema, objects are merged and other values are replaced
+        if not isinstance(base, dict) or not isinstance(head, dict):
+            return head
+
+        merged = dict(base)
+        for key, value in head.items():
+            merged[key] = ActionModule.deep_merge(base[key], value) if key in base else value
+        return merged
+
     def read_values_file(self, value_file):
         # Find the source value file
         value_file_path = self._find_needle('files', value_file)
 
-        # Read value file
-        with open(value_file_path, 'r') as _file:
-            value_file_source = yaml.safe_load(_file)
+        # Parse file once while it's not changed
+        file_stat = os.stat(value_file_path)
+        cache_key = hashlib.sha256('{0}|{1}|{2}'.format(value_file_path, file_stat.st_mtime,
+                                                        file_stat.st_size).encode('utf-8')).hexdigest()
+        value_file_source = self.read_values_cache(cache_key)
+        if value_file_source is None:
+            with open(value_file_path, 'r') as _file:
+                value_file_source = {'values': yaml.load(_file, Loader=YamlLoader)}
+            self.save_values_cache(cache_key, value_file_source)
 
-        return value_file_source
+        return value_file_source['values'], cache_key
 
-    def get_module_args(self):
-        module_args = self._task.args.copy()
-        value_file = module_args['values_file']
-        values = module_args['values']
-        values_file_content = ''
+    def get_release_args(self, release_args):
+        release_args = release_args.copy()
+        value_file = release_args.get('values_file', '')
+        values = release_args.get('values', '')
 
         # Read values file
         if value_file != '':
-            values_file_content = self.read_values_file(value_file)
-
-        # Render values
-        if value_file != '' and values != '':
-            values_content = merge(values_file_content, values)
-        elif value_file != '':
-            values_content = values_file_content
-        elif values != '':
-            values_content = values
+            start_time = time.time()
+            (values_file_content, values_file_key) = self.read_values_file(value_file)
+            self.record_timing('read_values_file', start_time)
+
+            # The same file and values are merged once
+            start_time = time.time()
+            merge_key = hashlib.sha256('{0}|{1}'.format(values_file_key, json.dumps(
+                values, sort_keys=True, cls=AnsibleJSONEncoder)).encode('utf-8')).hexdigest()
+            merged_values = self.read_values_cache(merge_key)
+            if merged_values is None:
+                values_content = self.deep_merge(values_file_content, values) if values != '' else values_file_content
+                merged_values = {'values': values_content, 'values_digest': self.get_values_digest(values_content)}
+                self.save_values_cache(merge_key, merged_values)
+            self.record_timing('merge_values', start_time)
         else:
-            values_content = ''
+            merged_values = {'values': values, 'values_digest': self.get_values_digest(values)}
 
         # Save final version of values to args
+        values_content = merged_values['values']
+        release_args['values'] = values_content
+        release_args['values_digest'] = merged_values['values_digest']
         if values_content != '':
-            module_args['values'] = values_content
-            del module_args['values_file']
+            release_args.pop('values_file', None)
+
+        return release_args
+
+    @staticmethod
+    def get_manifest_resources_digest(manifest):
+        # Must produce the same digest as helm_shell module for 'helm get manifest' output
+        resource_hashes = []
+        resource_hash = hashlib.sha256()
+        has_content = False
+        for line in io.StringIO(manifest):
+            if line.startswith('---'):
+                if has_content:
+                    resource_hashes.append(resource_hash.hexdigest())
+                resource_hash = hashlib.sha256()
+                has_content = False
+            elif line.strip() and not line.startswith('#'):
+                resource_hash.update(line.encode('utf-8'))
+                has_content = True
+        if has_content:
+            resource_hashes.append(resource_hash.hexdigest())
+
+        return hashlib.sha256('\n'.join(sorted(resource_hashes)).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def evict_render_cache(render_cache_dir, render_cache_size):
+        # Least recently used renders are removed first
+        renders = []
+        for file_name in os.listdir(render_cache_dir):
+            if file_name.endswith('.json'):
+                file_stat = os.stat(os.path.join(render_cache_dir, file_name))
+                renders.append((file_stat.st_mtime, file_stat.st_size, file_name))
+
+        cache_size = sum(file_size for _, file_size, _ in renders)
+        for _, file_size, file_name in sorted(renders):
+            if cache_size <= render_cache_size * 1024 * 1024:
+                break
+            try:
+                os.remove(os.path.join(render_cache_dir, file_name))
+            except OSError:
+                pass
+            cache_size -= file_size
+
+    def render_release(self, release_args, namespace):
+        result = {'failed': False, 'message': 'None', 'reason': 'None', 'calls': 0, 'output_bytes': 0}
+        source = release_args['source']
+        version = release_args.get('version') or ''
+        cmd = ['helm', 'template', release_args['chart_deploy_name']]
+
+        # Local chart is identified by its content, repo chart by its exact version
+        if source['type'] == 'local':
+            chart_path = self._find_needle('files', source['location'])
+            if os.path.isdir(chart_path):
+                chart_digest = hashlib.sha256(json.dumps([[relative_path, file_mode, file_digest] for (
+                    relative_path, file_mode, file_digest, _) in self.get_chart_files(chart_path)]).encode('utf-8'))
+                chart_digest = chart_digest.hexdigest()
+            else:
+                chart_digest = self.get_file_digest(chart_path)
+            cmd.append(chart_path)
+        elif source.get('username'):
+            # helm template takes repo password only as argument, which is visible in process list
+            result['failed'] = True
+            result['message'] = 'Chart {0} is not rendered on controller'.format(release_args['chart_deploy_name'])
+            result['reason'] = 'repo requires authentication'
+            return result, None
+        elif EXACT_VERSION_RE.match(version):
+            chart_digest = '{0}|{1}'.format(source['location'], release_args['name'])
+            cmd += [release_args['name'], '--repo', source['location'], '--version', version]
+        else:
+            result['failed'] = True
+            result['message'] = 'Chart {0} is not rendered on controller'.format(release_args['chart_deploy_name'])
+            result['reason'] = 'version of repo chart must be exact'
+            return result, None
+        cmd += ['--namespace', namespace, '--no-hooks']
+
+        # Renders are cached by chart, values, namespace and release name
+        render_key = hashlib.sha256(json.dumps([chart_digest, version, release_args['values_digest'], namespace,
+                                                release_args['chart_deploy_name']]).encode('utf-8')).hexdigest()
+        render_path = os.path.join(self._render['cache_dir'], render_key + '.json')
+        try:
+            with open(render_path, 'r') as _file:
+                render = json.load(_file)
+            os.utime(render_path, None)
+            return result, render
+        except Exception:
+            pass
+
+        values_data = None
+        if release_args['values'] != '':
+            cmd += ['-f', '-']
+            values_data = json.dumps(release_args['values'], sort_keys=True, cls=AnsibleJSONEncoder)
+        try:
+            process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            (out, err) = process.communicate(values_data.encode('utf-8') if values_data is not None else None)
+        except Exception as err:
+            result['failed'] = True
+            result['message'] = 'Can\'t run helm template on localhost'
+            result['reason'] = str(err)
+            return result, None
+        result['calls'] = 1
+        result['output_bytes'] = len(out)
+        if process.returncode != 0:
+            result['failed'] = True
+            result['message'] = 'Can\'t render chart {0} on localhost'.format(release_args['chart_deploy_name'])
+            result['reason'] = err.decode('utf-8', 'replace').strip()
+            return result, None
+
+        manifest = out.decode('utf-8')
+        render = {'manifest': manifest, 'manifest_digest': self.get_manifest_resources_digest(manifest)}
+        try:
+            if not os.path.isdir(self._render['cache_dir']):
+                os.makedirs(self._render['cache_dir'])
+            tmp_file_fd, tmp_file_path = tempfile.mkstemp(dir=self._render['cache_dir'])
+            with os.fdopen(tmp_file_fd, 'w') as _file:
+                json.dump(render, _file)
+            os.rename(tmp_file_path, render_path)
+            self.evict_render_cache(self._render['cache_dir'], self._render['cache_size'])
+        except Exception:
+            pass
+
+        return result, render
+
+    def prepare_release(self, release_args, remote_tmp_dir, remote_cache_dir, values_transfer, namespace='default'):
+        content_tempfile = ''
+
+        # Get release args
+        release_args = self.get_release_args(release_args)
+        result = {'failed': False, 'message': 'None', 'reason': 'None'}
+
+        # Render chart once on controller instead of rendering it on every host
+        render = None
+        if self._render['mode'] == 'controller' and release_args.get('state', self._render['state']) != 'absent':
+            start_time = time.time()
+            render_result, render = self.render_release(release_args, namespace)
+            self.record_timing('render_chart', start_time, render_result['calls'], render_result['output_bytes'])
+            if render_result['failed']:
+                display.warning('{0}: {1}, chart is rendered on remote host'.format(render_result['message'],
+                                                                                    render_result['reason']))
+            else:
+                release_args['rendered_manifest_digest'] = render['manifest_digest']
+
+        # Check mode compares rendered manifest with deployed one, chart and values are not uploaded
+        if render is not None and self._play_context.check_mode:
+            start_time = time.time()
+            result, release_args['rendered_manifest_file'], content_tempfile = self.upload_manifest_file(
+                render['manifest'], remote_tmp_dir)
+            self.record_timing('upload_manifest_file', start_time, 1, len(render['manifest']))
+            release_args.pop('values', None)
+            return result, release_args, content_tempfile
+
+        # Save values to file, with 'stdin' transfer values are passed in module args
+        if release_args['values'] != '' and values_transfer == 'file':
+            start_time = time.time()
+            result, release_args['values_file'], content_tempfile = self.upload_values_file(release_args['values'],
+                                                                                            remote_tmp_dir)
+            self.record_timing('upload_values_file', start_time, 1,
+                               os.path.getsize(content_tempfile) if content_tempfile else 0)
+            if result['failed']:
+                return result, release_args, content_tempfile
+
+        if release_args['values'] == '' or values_transfer == 'file':
+            del release_args['values']
+
+        # Upload helm chart
+        if release_args['source']['type'] == 'local':
+            release_args['source'] = release_args['source'].copy()
+            start_time = time.time()
+            result, release_args['source']['location'] = self.upload_helm_chart(release_args['source']['location'],
+                                                                                remote_tmp_dir, remote_cache_dir)
+            self.record_timing('upload_helm_chart', start_time, result.pop('calls'), result.pop('output_bytes'))
+
+            # Chart directory is packaged on remote host from uploaded files
+            if 'chart_files' in result:
+                release_args['source']['files'] = result.pop('chart_files')
 
-        return module_args
+        return result, release_args, content_tempfile
+
+    @staticmethod
+    def check_release_dependencies(releases):
+        result = {'failed': False, 'message': 'None', 'reason': 'None'}
+        release_names = [release.get('chart_deploy_name') for release in releases]
+        dependencies = []
+
+        # Every dependency must be one release of the same task
+        for release in releases:
+            depends_on = release.get('depends_on') or []
+            if not isinstance(depends_on, list):
+                depends_on = [depends_on]
+            for dependency in depends_on:
+                if release_names.count(dependency) != 1 or release_names.count(release.get('chart_deploy_name')) > 1:
+                    result['failed'] = True
+                    result['msg'] = result['message'] = ('Release {0} depends on {1}, which must be one release '
+                                                         'of the same task').format(release.get('chart_deploy_name'),
+                                                                                    dependency)
+                    return result
+            dependencies.append(set(depends_on))
+
+        # Releases are only checked for cycle, module schedules them and returns results in the task order
+        deployed = set()
+        pending = list(range(len(releases)))
+        while pending:
+            ready = [index for index in pending if dependencies[index] <= deployed]
+            if not ready:
+                result['failed'] = True
+                result['msg'] = result['message'] = 'Releases have dependency cycle: {0}'.format(
+                    ', '.join(release_names[index] for index in pending))
+                return result
+            for index in ready:
+                pending.remove(index)
+            deployed.update(release_names[index] for index in ready)
+
+        return result
 
     def run(self, tmp=None, task_vars=None):
 
         super(ActionModule, self).run(tmp, task_vars)
-        content_tempfile = ''
+        content_tempfiles = []
+        chart_cache_hits = {}
+        self._timings = {}
 
         # Get module args
-        module_args = self.get_module_args()
+        module_args = self._task.args.copy()
 
         # Create tmp dir on remote host
         result, remote_tmp_dir = self.create_remote_tmp_dir()
         if result['failed']:
             return result
 
-        # Save values to file
-        if module_args['values'] != '':
-            result, module_args['values_file'], content_tempfile = self.upload_values_file(module_args['values'],
-                                                                                           remote_tmp_dir)
+        # Values transfer is done by action plugin only
+        values_transfer = module_args.pop('values_transfer', 'file')
+        if values_transfer not in ['file', 'stdin']:
+            return {'failed': True, 'msg': 'values_transfer must be one of: file, stdin'}
+
+        # Charts are rendered on remote host by helm upgrade, or once on controller by helm template
+        self._render = {'mode': module_args.pop('render', 'target'),
+                        'cache_dir': os.path.expanduser(module_args.pop('render_cache_dir',
+                                                                        '~/.cache/helm_shell/renders')),
+                        'cache_size': int(module_args.pop('render_cache_size', 256)),
+                        'state': module_args.get('state', 'present')}
+        if self._render['mode'] not in ['target', 'controller']:
+            return {'failed': True, 'msg': 'render must be one of: target, controller'}
+
+        # Local charts are cached on remote host
+        module_args['chart_cache_dir'] = self._remote_expand_user(
+            module_args.get('chart_cache_dir', '~/.cache/helm_shell/charts'), sudoable=False)
+
+        # Prepare values and charts for every release
+        if module_args.get('releases'):
+            module_args.pop('values', None)
+            module_args.pop('values_file', None)
+
+            # Check dependencies before any file is uploaded
+            result = self.check_release_dependencies(module_args['releases'])
             if result['failed']:
                 return result
 
-        del module_args['values']
-
-        # Upload helm chart
-        if module_args['source']['type'] == 'local':
-            result, module_args['source']['location'] = self.upload_helm_chart(module_args['source']['location'],
-                                                                               remote_tmp_dir)
+            releases = []
+            for release in module_args['releases']:
+                result, release_args, content_tempfile = self.prepare_release(
+                    release, remote_tmp_dir, module_args['chart_cache_dir'], values_transfer,
+                    release.get('namespace') or module_args.get('namespace') or 'default')
+                content_tempfiles.append(content_tempfile)
+                if result['failed']:
+                    return result
+                if 'chart_cache_hit' in result:
+                    chart_cache_hits[release_args['chart_deploy_name']] = result['chart_cache_hit']
+                releases.append(release_args)
+            module_args['releases'] = releases
+        # Jobs poll, releases gathering and history pruning don't need values and charts
+        elif module_args.get('jobs') is None and not module_args.get('gather') and not module_args.get('prune_history'):
+            result, module_args, content_tempfile = self.prepare_release(module_args, remote_tmp_dir,
+                                                                         module_args['chart_cache_dir'],
+                                                                         values_transfer,
+                                                                         module_args.get('namespace') or 'default')
+            content_tempfiles.append(content_tempfile)
             if result['failed']:
                 return result
+            if 'chart_cache_hit' in result:
+                chart_cache_hits[module_args['chart_deploy_name']] = result['chart_cache_hit']
 
         # Execute helm_shell module
+        start_time = time.time()
         module_return = self._execute_module(module_name='helm_shell',
                                              module_args=module_args,
                                              task_vars=task_vars, tmp=tmp)
+        self.record_timing('execute_module', start_time, 1)
+
+        # Add action plugin phases to module timings
+        module_return.setdefault('timings', {}).update(self._timings)
+
+        # Report chart cache status
+        if 'results' in module_return:
+            for release_return in module_return['results']:
+                if release_return['chart_deploy_name'] in chart_cache_hits:
+                    release_return['chart_cache_hit'] = chart_cache_hits[release_return['chart_deploy_name']]
+        elif chart_cache_hits:
+            module_return['chart_cache_hit'] = list(chart_cache_hits.values())[0]
 
         # Cleanup tmp the files
-        if content_tempfile != '':
-            try:
-                os.remove(content_tempfile)
-            except Exception as err:
-                raise Exception('Cant remove tmp file on localhost. Reason: ' + str(err))
+        for content_tempfile in content_tempfiles:
+            if content_tempfile != '':
+                try:
+                    os.remove(content_tempfile)
+                except Exception as err:
+                    raise Exception('Cant remove tmp file on localhost. Reason: ' + str(err))
 
         return module_return
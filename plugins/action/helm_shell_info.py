@@ -0,0 +1,35 @@
+#!/usr/bin/python
+
+from __future__ import (absolute_import, division, print_function)
+
+__metaclass__ = type
+
+import time
+
+from ansible.plugins.action import ActionBase
+
+
+class ActionModule(ActionBase):
+
+    def run(self, tmp=None, task_vars=None):
+
+        super(ActionModule, self).run(tmp, task_vars)
+
+        # Releases are listed by helm_shell module, which shares release inventory cache with deploy tasks
+        module_args = dict((key, value) for key, value in self._task.args.items()
+                           if key in ['release_cache_ttl', 'cache_dir', 'profile_file'])
+        module_args['gather'] = True
+
+        start_time = time.time()
+        module_return = self._execute_module(module_name='helm_shell',
+                                             module_args=module_args,
+                                             task_vars=task_vars, tmp=tmp)
+        if module_return.get('failed'):
+            return module_return
+
+        # Facts can be passed to helm_shell as release_inventory
+        release_inventory = module_return.pop('release_inventory')
+        module_return['ansible_facts'] = {'helm_releases': release_inventory}
+        module_return.setdefault('timings', {})['execute_module'] = {
+            'time': round(time.time() - start_time, 6), 'calls': 1, 'output_bytes': 0}
+        return module_return
@@ -1,9 +1,36 @@
 #!/usr/bin/python
+import cProfile
+import contextlib
+import difflib
+import fcntl
+import functools
+import gzip
+import hashlib
+import io
 import json
 import os
+import re
+import shlex
 import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.six.moves.urllib.parse import urlsplit, urlunsplit
+
+try:
+    import yaml
+
+    YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    HAS_YAML = True
+except ImportError:
+    HAS_YAML = False
 
 ANSIBLE_METADATA = {
     'metadata_version': '1.2',
@@ -36,25 +63,128 @@ EXAMPLES = '''
 RETURN = '''
 '''
 
-module_args = dict(
+release_args = dict(
     name=dict(type='str', required=True),
     chart_deploy_name=dict(type='str', required=True),
     version=dict(type='str', required=False),
     source=dict(type='dict', required=True),
+    namespace=dict(type='str', required=False),
+    state=dict(type='str', required=False),
+    values_file=dict(type='str', required=False),
+    values=dict(type='raw', required=False),
+    force=dict(type='bool', required=False),
+    create_namespace=dict(type='bool', required=False),
+    wait=dict(type='bool', required=False),
+    wait_mode=dict(type='str', required=False, choices=['sync', 'async']),
+    timeout=dict(type='int', required=False),
+    history_max=dict(type='int', required=False),
+    values_digest=dict(type='str', required=False),
+    skip_unchanged=dict(type='bool', required=False),
+    depends_on=dict(type='list', elements='str', required=False),
+    rendered_manifest_file=dict(type='str', required=False),
+    rendered_manifest_digest=dict(type='str', required=False)
+)
+
+module_args = dict(
+    name=dict(type='str', required=False),
+    chart_deploy_name=dict(type='str', required=False),
+    version=dict(type='str', required=False),
+    source=dict(type='dict', required=False),
     namespace=dict(type='str', required=False, default='default'),
     state=dict(type='str', required=False, default='present'),
     values_file=dict(type='str', required=False, default=''),
+    values=dict(type='raw', required=False),
     force=dict(type='bool', required=False, default=False),
     create_namespace=dict(type='bool', required=False, default=True),
     wait=dict(type='bool', required=False, default=False),
-    timeout=dict(type='int', required=False, default=300)
+    wait_mode=dict(type='str', required=False, default='sync', choices=['sync', 'async']),
+    timeout=dict(type='int', required=False, default=300),
+    history_max=dict(type='int', required=False),
+    values_digest=dict(type='str', required=False, default=''),
+    skip_unchanged=dict(type='bool', required=False, default=True),
+    rendered_manifest_file=dict(type='str', required=False),
+    rendered_manifest_digest=dict(type='str', required=False),
+    return_manifest=dict(type='str', required=False, default='summary', choices=['none', 'digest', 'summary', 'full']),
+    repo_cache_ttl=dict(type='int', required=False, default=300),
+    release_cache_ttl=dict(type='int', required=False, default=300),
+    cache_dir=dict(type='path', required=False, default='~/.cache/helm_shell'),
+    chart_cache_dir=dict(type='path', required=False, default='~/.cache/helm_shell/charts'),
+    chart_cache_size=dict(type='int', required=False, default=1024),
+    releases=dict(type='list', elements='dict', required=False, options=release_args),
+    max_workers=dict(type='int', required=False, default=4),
+    check_level=dict(type='str', required=False, default='fast', choices=['fast', 'full']),
+    jobs=dict(type='list', elements='dict', required=False),
+    gather=dict(type='bool', required=False),
+    release_inventory=dict(type='dict', required=False),
+    prune_history=dict(type='bool', required=False),
+    kube_contexts=dict(type='list', elements='dict', required=False, options=dict(
+        name=dict(type='str', required=True),
+        kubeconfig=dict(type='path', required=False)
+    )),
+    max_output_size=dict(type='int', required=False, default=512),
+    profile_file=dict(type='path', required=False)
 )
 
 module = AnsibleModule(
     argument_spec=module_args,
+    required_one_of=[['chart_deploy_name', 'releases', 'jobs', 'gather', 'prune_history']],
+    mutually_exclusive=[['chart_deploy_name', 'releases', 'jobs', 'gather', 'prune_history']],
+    required_together=[['name', 'chart_deploy_name', 'source']],
     supports_check_mode=True
 )
 
+# Parsed helm repositories.yaml, reloaded when file is changed
+repo_registry = {'key': None, 'names': {}, 'urls': {}}
+repo_registry_lock = threading.Lock()
+
+# Per phase wall-clock time, number of helm calls and size of helm output
+timings = {}
+timings_lock = threading.Lock()
+current_phases = threading.local()
+
+# Kube context flags of helm calls made by current thread
+current_kube = threading.local()
+
+# Cluster identity of every kube context, resolved once per module process
+kube_identities = {}
+kube_identities_lock = threading.Lock()
+
+# Path to helm and kubectl binaries and 'helm env' output, resolved once per module process
+helm_env = {'bin': None, 'env': None, 'kubectl': None}
+helm_env_lock = threading.Lock()
+
+# Only the tail of helm stderr is kept for error messages
+MAX_STDERR_SIZE = 64 * 1024
+
+
+# Job dirs are removed when they are not polled for a day after deadline
+JOB_RETENTION = 24 * 3600
+
+# Runs helm command of async job detached from module and saves its return code
+JOB_RUNNER = """
+import json, os, subprocess, sys
+# Helm output may contain secret values, only owner can read it
+os.umask(0o077)
+job_dir = sys.argv[1]
+with open(os.path.join(job_dir, 'job.json')) as job_file:
+    job = json.load(job_file)
+stdin_path = os.path.join(job_dir, 'stdin')
+stdin = open(stdin_path, 'rb') if os.path.exists(stdin_path) else None
+with open(os.path.join(job_dir, 'stdout'), 'wb') as stdout, open(os.path.join(job_dir, 'stderr'), 'wb') as stderr:
+    rc = subprocess.call(job['cmd'], stdin=stdin, stdout=stdout, stderr=stderr, close_fds=True)
+with open(os.path.join(job_dir, 'rc.tmp'), 'w') as rc_file:
+    rc_file.write(str(rc))
+os.rename(os.path.join(job_dir, 'rc.tmp'), os.path.join(job_dir, 'rc'))
+"""
+
+
+class HelmCommandError(Exception):
+    def __init__(self, cmd, err):
+        super(HelmCommandError, self).__init__(err)
+        self.cmd = cmd
+        self.err = err
+
+
 result = dict(
     changed=False,
     original_message='',
@@ -62,6 +192,348 @@ result = dict(
 )
 
 
+def timed_phase(phase):
+    """
+    Args:
+        phase (str): phase name in timings result
+    Returns:
+        decorator which records wall-clock time of function to phase
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            phase_stack = get_phase_stack()
+            phase_stack.append(phase)
+            start_time = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                phase_stack.pop()
+                record_timing(phase, time.time() - start_time)
+        return wrapper
+    return decorator
+
+
+def get_phase_stack():
+    """
+    Returns:
+        list - phases entered by current thread
+    """
+    if not hasattr(current_phases, 'stack'):
+        current_phases.stack = []
+    return current_phases.stack
+
+
+def record_timing(phase, duration=0.0, calls=0, output_bytes=0, helm_time=0.0):
+    """
+    Args:
+        phase (str): phase name in timings result
+        duration (float): seconds spent in phase
+        calls (int): number of helm calls
+        output_bytes (int): size of helm output
+        helm_time (float): seconds spent in helm processes
+    """
+    with timings_lock:
+        phase_timing = timings.setdefault(phase, {'time': 0.0, 'calls': 0, 'output_bytes': 0, 'helm_time': 0.0})
+        phase_timing['time'] = round(phase_timing['time'] + duration, 6)
+        phase_timing['calls'] += calls
+        phase_timing['output_bytes'] += output_bytes
+        phase_timing['helm_time'] = round(phase_timing['helm_time'] + helm_time, 6)
+
+
+@contextlib.contextmanager
+def kube_context(context_name, kubeconfig):
+    """
+    Helm calls of current thread are made to the kube context
+
+    Args:
+        context_name (str): kube context name, current context if empty
+        kubeconfig (str): path to kubeconfig, default kubeconfig if empty
+    """
+    previous_context = getattr(current_kube, 'context', ('', ''))
+    current_kube.context = (context_name or '', kubeconfig or '')
+    try:
+        yield
+    finally:
+        current_kube.context = previous_context
+
+
+def get_kube_args():
+    """
+    Returns:
+        list - helm flags of kube context used by current thread
+    """
+    (context_name, kubeconfig) = getattr(current_kube, 'context', ('', ''))
+    kube_args = []
+    if context_name:
+        kube_args += ['--kube-context', context_name]
+    if kubeconfig:
+        kube_args += ['--kubeconfig', kubeconfig]
+    return kube_args
+
+
+def get_kubeconfig_cluster(kubeconfig_paths, context_name):
+    """
+    Args:
+        kubeconfig_paths (list): kubeconfig files, first file which sets a value wins
+        context_name (str): kube context name, current context if empty
+    Returns:
+        list - context name, cluster name and API server, digest of kubeconfig files if they can't be parsed
+    """
+    if HAS_YAML:
+        kubeconfig = {'current-context': '', 'contexts': {}, 'clusters': {}}
+        try:
+            for kubeconfig_path in kubeconfig_paths:
+                if not os.path.isfile(kubeconfig_path):
+                    continue
+                with open(kubeconfig_path, 'r') as _file:
+                    content = yaml.load(_file, Loader=YamlLoader) or {}
+                kubeconfig['current-context'] = kubeconfig['current-context'] or content.get('current-context') or ''
+                for section in ['contexts', 'clusters']:
+                    for item in content.get(section) or []:
+                        kubeconfig[section].setdefault(item.get('name'), item.get(section[:-1]) or {})
+            context_name = context_name or kubeconfig['current-context']
+            cluster_name = kubeconfig['contexts'].get(context_name, {}).get('cluster', '')
+            return [context_name, cluster_name, kubeconfig['clusters'].get(cluster_name, {}).get('server', '')]
+        except (IOError, OSError, AttributeError, yaml.YAMLError):
+            pass
+
+    # Without PyYAML any change of kubeconfig files, e.g. 'kubectl config use-context', changes identity
+    kubeconfig_digest = hashlib.sha256(context_name.encode('utf-8'))
+    for kubeconfig_path in kubeconfig_paths:
+        try:
+            with open(kubeconfig_path, 'rb') as _file:
+                kubeconfig_digest.update(_file.read())
+        except (IOError, OSError):
+            pass
+    return [kubeconfig_digest.hexdigest()]
+
+
+def get_kube_identity():
+    """
+    Returns:
+        str - digest of kubeconfig files, kube context and API server used by helm calls of current thread
+    """
+    (context_name, kubeconfig) = getattr(current_kube, 'context', ('', ''))
+    with kube_identities_lock:
+        if (context_name, kubeconfig) in kube_identities:
+            return kube_identities[(context_name, kubeconfig)]
+
+    # Cluster is switched by kube args, KUBECONFIG and HELM_KUBECONTEXT env or current context of kubeconfig
+    if kubeconfig:
+        kubeconfig_paths = [kubeconfig]
+    else:
+        kubeconfig_paths = (os.environ.get('KUBECONFIG') or os.path.join('~', '.kube', 'config')).split(os.pathsep)
+    kubeconfig_paths = [os.path.abspath(os.path.expanduser(path)) for path in kubeconfig_paths if path]
+    kube_identity = [kubeconfig_paths, os.environ.get('HELM_KUBEAPISERVER', '')] + get_kubeconfig_cluster(
+        kubeconfig_paths, context_name or os.environ.get('HELM_KUBECONTEXT', ''))
+    kube_identity = hashlib.sha256(json.dumps(kube_identity).encode('utf-8')).hexdigest()[:16]
+
+    with kube_identities_lock:
+        kube_identities[(context_name, kubeconfig)] = kube_identity
+    return kube_identity
+
+
+def get_cluster_cache_name(cache_name):
+    """
+    Args:
+        cache_name (str): name of cache of current cluster
+    Returns:
+        str - name of cache and its lock for cluster used by current thread
+    """
+    return cache_name + '-' + get_kube_identity()
+
+
+def get_helm_bin():
+    """
+    Returns:
+        str - path to helm binary, module fails when helm is not found
+    """
+    with helm_env_lock:
+        if helm_env['bin'] is None:
+            helm_env['bin'] = module.get_bin_path('helm', required=True)
+        return helm_env['bin']
+
+
+def get_helm_env():
+    """
+    Returns:
+        dict - variables of 'helm env', empty when helm can't report them
+    """
+    if helm_env['env'] is not None:
+        return helm_env['env']
+
+    # Output of 'helm env' depends only on helm binary and environment, it's cached between tasks
+    helm_bin = get_helm_bin()
+    try:
+        helm_bin_mtime = os.stat(helm_bin).st_mtime
+    except OSError:
+        helm_bin_mtime = None
+    env_key = hashlib.sha256(json.dumps([helm_bin, helm_bin_mtime, sorted(
+        (key, value) for key, value in os.environ.items()
+        if key.startswith(('HELM_', 'XDG_')) or key in ['HOME', 'KUBECONFIG'])]).encode('utf-8')).hexdigest()
+    env_cache = read_cache_file('helm_env.json')
+    if env_cache.get('key') == env_key:
+        helm_env['env'] = env_cache['env']
+        return helm_env['env']
+
+    (_rc, env_raw, _err) = run_helm(['env'])
+    env = {}
+    for line in env_raw.splitlines() if not _rc else []:
+        if '=' in line:
+            key, value = line.split('=', 1)
+            env[key.strip()] = value.strip().strip('"')
+    if env:
+        write_cache_file('helm_env.json', {'key': env_key, 'env': env})
+
+    helm_env['env'] = env
+    return env
+
+
+def format_helm_cmd(args, command='helm'):
+    """
+    Args:
+        args (list): helm arguments
+        command (str): command name
+    Returns:
+        str - shell-quoted command for task result, passwords are masked
+    """
+    cmd = [command]
+    for index, arg in enumerate(args):
+        cmd.append('********' if index and args[index - 1] == '--password' else shlex.quote(arg))
+    return ' '.join(cmd)
+
+
+def run_helm(args, data=None):
+    """
+    Args:
+        args (list): helm arguments, helm is run without shell
+        data (str): data passed to helm stdin
+    Returns:
+        int - return code
+        str - stdout
+        str - stderr, only its tail when it's large
+    """
+    return run_process([get_helm_bin()] + args + get_kube_args(), format_helm_cmd(args), data)
+
+
+def run_kubectl(args):
+    """
+    Args:
+        args (list): kubectl arguments, kubectl is run without shell
+    Returns:
+        int - return code
+        str - stdout
+        str - stderr, only its tail when it's large
+    """
+    with helm_env_lock:
+        if helm_env.get('kubectl') is None:
+            helm_env['kubectl'] = module.get_bin_path('kubectl', required=True)
+
+    # kubectl names kube context flag differently from helm
+    kube_args = ['--context' if arg == '--kube-context' else arg for arg in get_kube_args()]
+    return run_process([helm_env['kubectl']] + args + kube_args, format_helm_cmd(args, 'kubectl'))
+
+
+def run_process(cmd, cmd_string, data=None):
+    """
+    Args:
+        cmd (list): command and its arguments
+        cmd_string (str): command for error messages
+        data (str): data passed to stdin
+    Returns:
+        int - return code
+        str - stdout
+        str - stderr, only its tail when it's large
+    """
+    max_output_size = module.params['max_output_size'] * 1024 * 1024
+    start_time = time.time()
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE if data is not None else subprocess.DEVNULL,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+
+    # Stdin and stderr are served by threads, so process never blocks on a full pipe
+    def write_stdin():
+        try:
+            process.stdin.write(data.encode('utf-8'))
+            process.stdin.close()
+        except (IOError, OSError):
+            pass
+
+    err_chunks = []
+
+    def read_stderr():
+        err_size = 0
+        for chunk in iter(lambda: process.stderr.read(MAX_STDERR_SIZE), b''):
+            err_chunks.append(chunk)
+            err_size += len(chunk)
+            while err_size - len(err_chunks[0]) >= MAX_STDERR_SIZE:
+                err_size -= len(err_chunks.pop(0))
+
+    io_threads = [threading.Thread(target=read_stderr)]
+    if data is not None:
+        io_threads.append(threading.Thread(target=write_stdin))
+    for io_thread in io_threads:
+        io_thread.start()
+
+    # Output is read in chunks and process is stopped when output is over the limit
+    out = io.BytesIO()
+    out_size = 0
+    for chunk in iter(lambda: process.stdout.read(1024 * 1024), b''):
+        out_size += len(chunk)
+        if out_size > max_output_size:
+            process.kill()
+            break
+        out.write(chunk)
+    process.stdout.close()
+    _rc = process.wait()
+    for io_thread in io_threads:
+        io_thread.join()
+
+    _out = out.getvalue().decode('utf-8', 'replace')
+    out.close()
+    _err = b''.join(err_chunks).decode('utf-8', 'replace')
+    if out_size > max_output_size:
+        _rc = _rc or 1
+        _err = 'Output of {0} is over max_output_size of {1} MB. {2}'.format(
+            cmd_string, module.params['max_output_size'], _err).strip()
+
+    # Helm and kubectl calls are counted in innermost phase
+    phase_stack = get_phase_stack()
+    record_timing(phase_stack[-1] if phase_stack else 'other', calls=1, output_bytes=out_size + len(_err),
+                  helm_time=time.time() - start_time)
+    return _rc, _out, _err
+
+
+@contextlib.contextmanager
+def host_lock(lock_name):
+    """
+    Exclusive lock shared by all helm_shell processes and threads on the host
+
+    Args:
+        lock_name (str): name of lock file inside of cache_dir/locks
+    """
+    lock_dir = os.path.join(module.params['cache_dir'], 'locks')
+    try:
+        if not os.path.isdir(lock_dir):
+            os.makedirs(lock_dir)
+    except OSError:
+        pass
+
+    try:
+        lock_file = open(os.path.join(lock_dir, re.sub(r'[^\w.-]', '_', lock_name) + '.lock'), 'a')
+    except (IOError, OSError) as err:
+        module.warn('Cant open lock file {0}, continue without lock. Reason: {1}'.format(lock_name, str(err)))
+        yield
+        return
+
+    # Lock is released when file is closed, also when process is killed
+    with lock_file:
+        start_time = time.time()
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        record_timing('lock_wait', time.time() - start_time)
+        yield
+
+
 def remove_tmp_folder(values_file):
     if values_file != "":
         try:
@@ -70,6 +542,279 @@ def remove_tmp_folder(values_file):
             raise Exception('Cant remove tmp file on the remove host. Reason: ' + str(err))
 
 
+def read_cache_file(cache_name):
+    """
+    Args:
+        cache_name (str): file name inside of cache_dir
+    Returns:
+        dict - cached content or empty dict when cache is missing or broken
+    """
+    cache_path = os.path.join(module.params['cache_dir'], cache_name)
+    try:
+        with open(cache_path, 'r') as _file:
+            return json.load(_file)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def write_cache_file(cache_name, content):
+    """
+    Args:
+        cache_name (str): file name inside of cache_dir
+        content (dict): content to save
+    """
+    cache_dir = module.params['cache_dir']
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Write to temp file first, so parallel tasks never read half-written cache
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(tmp_fd, 'w') as _file:
+            json.dump(content, _file)
+        os.rename(tmp_path, os.path.join(cache_dir, cache_name))
+    except (IOError, OSError) as err:
+        module.warn('Cant save cache file {0}. Reason: {1}'.format(cache_name, str(err)))
+
+
+def evict_chart_cache(chart_cache_dir, chart_cache_size, keep_charts):
+    """
+    Args:
+        chart_cache_dir (str): path to cached charts
+        chart_cache_size (int): max size of cached charts and chart file blobs in MB
+        keep_charts (list): paths to charts and blobs used by this task
+    """
+    try:
+        cached_charts = [os.path.join(chart_cache_dir, chart) for chart in os.listdir(chart_cache_dir)
+                         if chart.endswith('.tgz')]
+        blobs_dir = os.path.join(chart_cache_dir, 'blobs')
+        if os.path.isdir(blobs_dir):
+            cached_charts += [os.path.join(blobs_dir, blob) for blob in os.listdir(blobs_dir)]
+        cached_charts = [(os.stat(chart), chart) for chart in cached_charts]
+    except OSError:
+        return
+
+    # Remove least recently used charts first
+    cache_size = sum(chart_stat.st_size for chart_stat, _ in cached_charts)
+    for chart_stat, chart in sorted(cached_charts, key=lambda item: item[0].st_mtime):
+        if cache_size <= chart_cache_size * 1024 * 1024:
+            break
+        if chart in keep_charts:
+            continue
+        try:
+            os.remove(chart)
+            cache_size -= chart_stat.st_size
+        except OSError as err:
+            module.warn('Cant remove chart {0} from cache. Reason: {1}'.format(chart, str(err)))
+
+
+def get_chart_cache_paths(release):
+    """
+    Args:
+        release (dict): normalized release spec
+    Returns:
+        list - paths to cached chart and its file blobs
+    """
+    if release['chart_source_type'] != 'local':
+        return []
+
+    blobs_dir = os.path.join(module.params['chart_cache_dir'], 'blobs')
+    return [release['chart_location']] + [os.path.join(blobs_dir, file_digest)
+                                          for (_, _, file_digest) in release['chart_files']]
+
+
+def get_file_digest(file_path):
+    """
+    Args:
+        file_path (str): path to file
+    Returns:
+        str - sha256 of file content
+    """
+    file_digest = hashlib.sha256()
+    with open(file_path, 'rb') as _file:
+        for chunk in iter(lambda: _file.read(1024 * 1024), b''):
+            file_digest.update(chunk)
+    return file_digest.hexdigest()
+
+
+@timed_phase('package_chart')
+def package_chart(chart_path, chart_files):
+    """
+    Args:
+        chart_path (str): path to chart archive in chart cache
+        chart_files (list): archive path, mode and digest of every chart file uploaded to blobs
+    """
+    blobs_dir = os.path.join(module.params['chart_cache_dir'], 'blobs')
+    tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(chart_path))
+
+    # Archive is written as stream with fixed owner and mtime, so the same files give the same archive
+    try:
+        with os.fdopen(tmp_fd, 'wb') as _file:
+            with gzip.GzipFile(filename='', mode='wb', fileobj=_file, mtime=0) as chart_gzip:
+                with tarfile.open(fileobj=chart_gzip, mode='w|') as chart_archive:
+                    for (archive_path, file_mode, file_digest) in chart_files:
+                        blob_path = os.path.join(blobs_dir, file_digest)
+                        # Truncated blob would be cached as chart of the same digest and reused by next runs
+                        if get_file_digest(blob_path) != file_digest:
+                            os.remove(blob_path)
+                            raise IOError('file {0} in chart cache is corrupted, removed'.format(archive_path))
+                        file_info = tarfile.TarInfo(archive_path)
+                        file_info.size = os.path.getsize(blob_path)
+                        file_info.mode = file_mode
+                        with open(blob_path, 'rb') as blob:
+                            chart_archive.addfile(file_info, blob)
+        os.rename(tmp_path, chart_path)
+    except (IOError, OSError) as err:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise HelmCommandError('', 'Cant package chart {0}. Reason: {1}'.format(chart_path, str(err)))
+
+
+def iter_manifest_resources(manifest, with_content=False):
+    """
+    Args:
+        manifest (str): multi-document YAML manifest rendered by helm
+        with_content (bool): add lines of every document as 'content'
+    Returns:
+        generator of dicts with apiVersion, kind, namespace, name and sha256 of every document
+    """
+    def new_resource():
+        resource = {'apiVersion': '', 'kind': '', 'namespace': '', 'name': '', 'hash': hashlib.sha256()}
+        if with_content:
+            resource['content'] = []
+        return resource
+
+    resource = new_resource()
+    in_metadata = False
+    has_content = False
+
+    # Read manifest line by line, documents are never copied
+    for line in io.StringIO(manifest):
+        if line.startswith('---'):
+            if has_content:
+                resource['hash'] = resource['hash'].hexdigest()
+                yield resource
+            resource = new_resource()
+            in_metadata = False
+            has_content = False
+            continue
+
+        if not line.strip() or line.startswith('#'):
+            continue
+
+        has_content = True
+        resource['hash'].update(line.encode('utf-8'))
+        if with_content:
+            resource['content'].append(line if line.endswith('\n') else line + '\n')
+
+        # Only top level keys and direct children of metadata are parsed
+        if not line[0].isspace():
+            in_metadata = line.startswith('metadata:')
+            for key in ['apiVersion', 'kind']:
+                if line.startswith(key + ':'):
+                    resource[key] = line.split(':', 1)[1].strip().strip('"\'')
+        elif in_metadata and line.startswith('  ') and not line[2].isspace():
+            for key in ['name', 'namespace']:
+                if line[2:].startswith(key + ':'):
+                    resource[key] = line.split(':', 1)[1].strip().strip('"\'')
+
+    if has_content:
+        resource['hash'] = resource['hash'].hexdigest()
+        yield resource
+
+
+def get_manifest_resources_digest(manifest):
+    """
+    Args:
+        manifest (str): manifest rendered by helm
+    Returns:
+        str - sha256 of sorted resource hashes, the same for manifests with the same resources in any order
+    """
+    resource_hashes = sorted(resource['hash'] for resource in iter_manifest_resources(manifest))
+    return hashlib.sha256('\n'.join(resource_hashes).encode('utf-8')).hexdigest()
+
+
+def get_manifest_report(manifest, return_manifest):
+    """
+    Args:
+        manifest (str): manifest rendered by helm
+        return_manifest (str): 'none', 'digest', 'summary' or 'full'
+    Returns:
+        dict - manifest info returned to controller
+    """
+    if return_manifest == 'none':
+        return {}
+    if return_manifest == 'full':
+        return {'manifest': manifest}
+
+    manifest_report = {'manifest_digest': hashlib.sha256(manifest.encode('utf-8')).hexdigest()}
+    if return_manifest == 'summary':
+        manifest_report['resources'] = [dict((key, resource[key]) for key in ['kind', 'namespace', 'name', 'hash']
+                                             if resource[key]) for resource in iter_manifest_resources(manifest)]
+    return manifest_report
+
+
+def get_manifest_diff(before_manifest, after_manifest):
+    """
+    Args:
+        before_manifest (str): manifest of deployed release
+        after_manifest (str): manifest rendered by helm for this task
+    Returns:
+        dict - diff with unified diff of added, removed and changed resources
+        dict - keys of added, removed and changed resources
+    """
+    def resource_key(resource):
+        return '/'.join([resource['apiVersion'], resource['kind'], resource['namespace'], resource['name']])
+
+    # Documents are matched by key, only documents with different hash are compared line by line
+    before_resources = {}
+    for resource in iter_manifest_resources(before_manifest, with_content=True):
+        before_resources.setdefault(resource_key(resource), resource)
+
+    diff_lines = []
+    resource_changes = {'added': [], 'removed': [], 'changed': []}
+    after_keys = set()
+    for resource in iter_manifest_resources(after_manifest, with_content=True):
+        key = resource_key(resource)
+        if key in after_keys:
+            continue
+        after_keys.add(key)
+
+        before_resource = before_resources.pop(key, None)
+        if before_resource is None:
+            resource_changes['added'].append(key)
+            diff_lines.extend(difflib.unified_diff([], resource['content'], 'before: ' + key, 'after: ' + key))
+        elif before_resource['hash'] != resource['hash']:
+            resource_changes['changed'].append(key)
+            diff_lines.extend(difflib.unified_diff(before_resource['content'], resource['content'],
+                                                   'before: ' + key, 'after: ' + key))
+
+    for key, resource in before_resources.items():
+        resource_changes['removed'].append(key)
+        diff_lines.extend(difflib.unified_diff(resource['content'], [], 'before: ' + key, 'after: ' + key))
+
+    return {'prepared': ''.join(diff_lines)}, resource_changes
+
+
+@timed_phase('get_deployed_manifest')
+def get_deployed_manifest(chart_deploy_name, chart_namespace):
+    """
+    Args:
+        chart_deploy_name (str): name of chart deployment
+        chart_namespace (str): chart namespace
+    Returns:
+        str - manifest of deployed release, empty if release has no manifest
+    """
+    helm_args = ['get', 'manifest', chart_deploy_name, '-n', chart_namespace]
+    (_rc, manifest, _err) = run_helm(helm_args)
+    if _rc and 'not found' in _err:
+        return ''
+    elif _rc:
+        raise HelmCommandError(format_helm_cmd(helm_args), _err)
+
+    return manifest
+
+
+@timed_phase('install_chart')
 def install_chart(**kwargs):
     """
     Kwargs:
@@ -84,10 +829,16 @@ def install_chart(**kwargs):
         chart_create_namespace (bool): create namespace if not exist
         chart_version (str): chart version
         values_file (str): path to chart value file
+        values (dict): chart values streamed to helm stdin
         check_mode (bool): add --dry-run flag
         force (bool): add --force flag
         chart_wait (bool): add --wait flag
         chart_timeout (int): add --timeout flag
+        history_max (int): add --history-max flag to upgrade
+        return_manifest (str): how manifest is returned 'none', 'digest', 'summary' or 'full'
+        diff_mode (bool): return diff of rendered and deployed manifests
+        deployed_manifest (str): manifest of deployed release, used with diff_mode
+        async_wait (bool): run helm with --wait in background and return job handle
     Returns:
         bool
         dict - raw output from helm install command
@@ -95,59 +846,93 @@ def install_chart(**kwargs):
         str - installation status
         str - command string
     """
-    # Starting build shell command
-    cmd_string = 'helm '
-
     # Get some vars
     install_type = kwargs.get('install_type')
     check_mode = kwargs.get('check_mode')
 
     # Define type of installation 'install' or 'update'
-    if install_type == 'upgrade' and check_mode is False:
-        cmd_string += ' {0} {1}'.format('upgrade -i', kwargs.get('chart_deploy_name'))
-    elif install_type == 'upgrade' and check_mode:
-        cmd_string += ' {0} -i --dry-run {1}'.format(kwargs.get('install_type'), kwargs.get('chart_deploy_name'))
-    elif install_type == 'install' and check_mode is False:
-        cmd_string += ' {0} {1}'.format(kwargs.get('install_type'), kwargs.get('chart_deploy_name'))
-    elif install_type == 'install' and check_mode:
-        cmd_string += ' {0} --dry-run {1}'.format(kwargs.get('install_type'), kwargs.get('chart_deploy_name'))
+    helm_args = ['upgrade', '-i'] if install_type == 'upgrade' else ['install']
+    if check_mode:
+        helm_args.append('--dry-run')
+    helm_args.append(kwargs.get('chart_deploy_name'))
 
     if kwargs.get('force') and install_type == 'upgrade':
-        cmd_string += ' --force'
+        helm_args.append('--force')
+
+    # Old revisions over limit are removed by helm on upgrade
+    if kwargs.get('history_max') is not None and install_type == 'upgrade':
+        helm_args += ['--history-max', str(kwargs.get('history_max'))]
 
     if kwargs.get('chart_create_namespace'):
-        cmd_string += ' --create-namespace'
+        helm_args.append('--create-namespace')
 
     if kwargs.get('replace'):
-        cmd_string += ' --replace'
+        helm_args.append('--replace')
 
     # Specify path fot local chart repo, and repo name for remote
     if kwargs.get('chart_source_type') == 'local':
-        cmd_string += ' {0} --namespace="{1}"'.format(kwargs.get('chart_location'), kwargs.get('chart_namespace'))
+        helm_args.append(kwargs.get('chart_location'))
     else:
-        cmd_string += ' {0}/{1} --namespace="{2}"'.format(kwargs.get('chart_source_name'), kwargs.get('chart_name'),
-                                                          kwargs.get('chart_namespace'))
+        helm_args.append('{0}/{1}'.format(kwargs.get('chart_source_name'), kwargs.get('chart_name')))
+    helm_args += ['--namespace', kwargs.get('chart_namespace')]
 
     # Specify chart version
     if kwargs.get('chart_version'):
-        cmd_string += ' --version="{0}"'.format(kwargs.get('chart_version'))
-
-    # Specify chart values file
-    if kwargs.get('values_file'):
-        cmd_string += ' -f {0}'.format(kwargs.get('values_file'))
+        helm_args += ['--version', kwargs.get('chart_version')]
+
+    # Specify chart values file, or read values from stdin
+    values_data = None
+    if kwargs.get('values'):
+        helm_args += ['-f', '-']
+        values_data = kwargs.get('values')
+        if not isinstance(values_data, str):
+            values_data = json.dumps(values_data)
+    elif kwargs.get('values_file') and kwargs.get('async_wait'):
+        # Values file is removed with tmp folder before async job is finished
+        helm_args += ['-f', '-']
+        with open(kwargs.get('values_file'), 'r') as _file:
+            values_data = _file.read()
+    elif kwargs.get('values_file'):
+        helm_args += ['-f', kwargs.get('values_file')]
 
     if kwargs.get('chart_wait'):
-        cmd_string += ' --wait --timeout {0}s'.format(kwargs.get('chart_timeout'))
+        helm_args += ['--wait', '--timeout', '{0}s'.format(kwargs.get('chart_timeout'))]
 
     # Set default output to json
-    cmd_string += ' --output json'
+    helm_args += ['--output', 'json']
+    cmd_string = format_helm_cmd(helm_args)
+
+    # Don't block on --wait, release readiness is checked by 'jobs' poll
+    if kwargs.get('async_wait'):
+        job = submit_job(helm_args, values_data, kwargs.get('chart_deploy_name'), kwargs.get('chart_namespace'),
+                         kwargs.get('chart_timeout'))
+        return True, {'job': job}, None, 'submitted', cmd_string
 
-    (_rc, chart_output_raw, _err) = module.run_command(cmd_string, use_unsafe_shell=True)
+    (_rc, chart_output_raw, _err) = run_helm(helm_args, data=values_data)
     if _rc:
-        return module.exit_json(original_message=_err, cmd=cmd_string, changed=False, failed=True)
+        raise HelmCommandError(cmd_string, _err)
 
+    (ex_result, chart_message, chart_diff, install_status) = parse_chart_output(
+        chart_output_raw, kwargs.get('return_manifest'), kwargs.get('diff_mode'), kwargs.get('deployed_manifest'))
+    return ex_result, chart_message, chart_diff, install_status, cmd_string
+
+
+def parse_chart_output(chart_output_raw, return_manifest, diff_mode, deployed_manifest):
+    """
+    Args:
+        chart_output_raw (str): JSON output of helm install or upgrade
+        return_manifest (str): how manifest is returned 'none', 'digest', 'summary' or 'full'
+        diff_mode (bool): return diff of rendered and deployed manifests
+        deployed_manifest (str): manifest of deployed release, None if release is not installed
+    Returns:
+        bool
+        dict - raw output from helm install command
+        dict - helm chart manifest
+        str - installation status
+    """
     # Load output to json format and pars installation code
     chart_output = json.loads(chart_output_raw)
+    del chart_output_raw
     install_status = chart_output['info']['status']
 
     chart_message = {}
@@ -159,7 +944,7 @@ def install_chart(**kwargs):
         chart_message.update({'namespace': chart_output['namespace']})
 
     if 'manifest' in chart_output:
-        chart_message.update({'manifest': chart_output['manifest']})
+        chart_message.update(get_manifest_report(chart_output['manifest'], return_manifest))
 
     if 'version' in chart_output:
         chart_message.update({'version': chart_output['version']})
@@ -170,121 +955,644 @@ def install_chart(**kwargs):
         if 'notes' in chart_output['info']:
             chart_message.update({'info': chart_output['info']['notes']})
 
-    chart_diff = {"prepared": chart_output['manifest'] + "\n" + chart_output['info']['notes']}
+    # Only added, removed and changed resources are returned as diff
+    chart_diff = None
+    if diff_mode:
+        (chart_diff, chart_message['resource_changes']) = get_manifest_diff(deployed_manifest or '',
+                                                                            chart_output.get('manifest', ''))
 
     if install_status in ['deployed', 'pending-upgrade', 'pending-install']:
-        return True, chart_message, chart_diff, install_status, cmd_string
+        return True, chart_message, chart_diff, install_status
     else:
-        return False, chart_message, chart_diff, install_status, cmd_string
+        return False, chart_message, chart_diff, install_status
 
 
-def get_chart_lists(chart_namespace):
+def write_job_file(job_dir, file_name, content):
     """
     Args:
-        chart_namespace(str): chart namespace
+        job_dir (str): path to job dir
+        file_name (str): file name inside of job dir
+        content (str): content to save
+    """
+    # Values passed to helm stdin may contain secrets, only owner can read them
+    with os.fdopen(os.open(os.path.join(job_dir, file_name), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600),
+                   'w') as _file:
+        _file.write(content)
+
+
+def expire_jobs(jobs_dir):
+    """
+    Args:
+        jobs_dir (str): path to dirs of async jobs
+    """
+    try:
+        job_ids = os.listdir(jobs_dir)
+    except OSError:
+        return
+
+    # Jobs which are never polled are removed after their deadline passes
+    for job_id in job_ids:
+        job_dir = os.path.join(jobs_dir, job_id)
+        try:
+            with open(os.path.join(job_dir, 'job.json'), 'r') as _file:
+                job_deadline = json.load(_file).get('deadline', 0)
+        except (IOError, OSError, ValueError):
+            # Job dir without job.json is being created by other task or was left by old version
+            try:
+                job_deadline = os.stat(job_dir).st_mtime
+            except OSError:
+                continue
+        if time.time() - job_deadline >= JOB_RETENTION:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+
+def submit_job(helm_args, values_data, chart_deploy_name, chart_namespace, chart_timeout):
+    """
+    Args:
+        helm_args (list): helm arguments
+        values_data (str): data passed to helm stdin
+        chart_deploy_name (str): name of chart deployment
+        chart_namespace (str): chart namespace
+        chart_timeout (int): helm --timeout in seconds
     Returns:
-        dist of all charts name and status
+        dict - job handle for 'jobs' poll
     """
-    _cmd_str = 'helm list -a -n {0} --output json'.format(chart_namespace)
-    (_rc, helm_chart_list_raw, _err) = module.run_command(_cmd_str, use_unsafe_shell=True)
-    if _rc:
-        return module.exit_json(original_message=_err, cmd=_cmd_str, changed=False, failed=True)
+    jobs_dir = os.path.join(module.params['cache_dir'], 'jobs')
+    expire_jobs(jobs_dir)
+    if not os.path.isdir(jobs_dir):
+        os.makedirs(jobs_dir, 0o700)
+    job_id = uuid.uuid4().hex
+    job_dir = os.path.join(jobs_dir, job_id)
+    os.mkdir(job_dir, 0o700)
+
+    job_deadline = time.time() + chart_timeout
+    write_job_file(job_dir, 'job.json', json.dumps({'cmd': [get_helm_bin()] + helm_args + get_kube_args(),
+                                                    'deadline': job_deadline}))
+    if values_data is not None:
+        write_job_file(job_dir, 'stdin', values_data)
+
+    # New session keeps job running after module exit
+    with open(os.devnull, 'r+') as devnull:
+        subprocess.Popen([sys.executable, '-c', JOB_RUNNER, job_dir], stdin=devnull, stdout=devnull, stderr=devnull,
+                         close_fds=True, start_new_session=True)
+    record_timing('submit_job', calls=1)
+
+    (context_name, kubeconfig) = getattr(current_kube, 'context', ('', ''))
+    return {'id': job_id, 'chart_deploy_name': chart_deploy_name, 'namespace': chart_namespace,
+            'kube_context': context_name, 'kubeconfig': kubeconfig, 'deadline': job_deadline}
+
+
+def poll_job(job, deadline, return_manifest):
+    """
+    Args:
+        job (dict): job handle returned by submit_job
+        deadline (float): time when polling of all jobs is stopped
+        return_manifest (str): how manifest is returned 'none', 'digest', 'summary' or 'full'
+    Returns:
+        dict - release result of job
+    """
+    job_result = {'chart_deploy_name': job['chart_deploy_name'], 'namespace': job['namespace'], 'job': job['id']}
+    if job.get('kube_context'):
+        job_result['kube_context'] = job['kube_context']
+    # Job dir is taken from job id only, so handle can't point poll to other files on the host
+    if not re.match(r'^[0-9a-f]{32}$', str(job.get('id'))):
+        job_result.update(changed=False, failed=True, ready=False,
+                          message='Job of release {0} has invalid id'.format(job['chart_deploy_name']))
+        return job_result
+    job_dir = os.path.join(module.params['cache_dir'], 'jobs', job['id'])
+    rc_path = os.path.join(job_dir, 'rc')
+    if not os.path.isdir(job_dir):
+        job_result.update(changed=False, failed=True, ready=False,
+                          message='Job of release {0} is not found, it was polled or expired'.format(
+                              job['chart_deploy_name']))
+        return job_result
+
+    # Wait for helm --wait to finish with backoff
+    backoff = 0.5
+    while not os.path.exists(rc_path):
+        if time.time() >= deadline:
+            job_result.update(changed=False, failed=True, ready=False,
+                              message='Release {0} is not ready before deadline'.format(job['chart_deploy_name']))
+            return job_result
+        time.sleep(min(backoff, max(deadline - time.time(), 0)))
+        backoff = min(backoff * 2, 10)
+
+    with open(rc_path, 'r') as _file:
+        job_rc = int(_file.read().strip() or 1)
+    with open(os.path.join(job_dir, 'stderr'), 'r') as _file:
+        job_err = _file.read()
+
+    if job_rc:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        job_result.update(changed=False, failed=True, ready=False, original_message=job_err,
+                          message='Release {0} is not ready'.format(job['chart_deploy_name']))
+        return job_result
+
+    with open(os.path.join(job_dir, 'stdout'), 'r') as _file:
+        (ex_result, msg, _, install_status) = parse_chart_output(_file.read(), return_manifest, False, None)
+    shutil.rmtree(job_dir, ignore_errors=True)
+
+    # Confirm that release wasn't changed after job
+    with kube_context(job.get('kube_context'), job.get('kubeconfig')):
+        deployed_chart = get_release(job['chart_deploy_name'], job['namespace'], None)
+    ready = ex_result and deployed_chart is not None and deployed_chart['status'] == 'deployed'
+    job_result.update(changed=True, failed=not ready, ready=ready, original_message=msg,
+                      message='Release {0} is {1}'.format(job['chart_deploy_name'],
+                                                          'ready' if ready else 'not ready'))
+    return job_result
+
+
+def run_poll(jobs, timeout):
+    """
+    Args:
+        jobs (list): job handles returned by submit_job
+        timeout (int): global deadline for all jobs in seconds
+    """
+    deadline = time.time() + timeout
+    expire_jobs(os.path.join(module.params['cache_dir'], 'jobs'))
+
+    # Jobs are mostly sleeping between checks, all of them are polled at the same time
+    executor = ThreadPoolExecutor(max_workers=max(1, len(jobs)))
+    try:
+        job_results = list(executor.map(lambda _job: poll_job(_job, deadline, module.params['return_manifest']),
+                                        jobs))
+    finally:
+        executor.shutdown(wait=True)
+
+    not_ready = [get_release_label(_result) for _result in job_results if not _result['ready']]
+    result['changed'] = any(_result['changed'] for _result in job_results)
+    result['failed'] = len(not_ready) > 0
+    result['results'] = job_results
+    result['timings'] = timings
+    if not_ready:
+        result['msg'] = result['message'] = 'Releases are not ready: {0}'.format(', '.join(not_ready))
+    else:
+        result['message'] = 'All {0} releases are ready'.format(len(job_results))
+    return module.exit_json(**result)
 
-    # Return None if no one charts installed
-    if len(helm_chart_list_raw) == 0:
-        return ''
+
+@timed_phase('release_inventory')
+def refresh_release_inventory():
+    """
+    Returns:
+        dict - release inventory with 'helm list' chart info of all releases in all namespaces
+    """
+    helm_args = ['list', '-A', '-a', '--output', 'json']
+    list_started = time.time()
+    (_rc, helm_chart_list_raw, _err) = run_helm(helm_args)
+    if _rc:
+        raise HelmCommandError(format_helm_cmd(helm_args), _err)
 
     # Parse chart names
-    helm_chart_list = {}
-    for chart in json.loads(helm_chart_list_raw):
-        helm_chart_list.update({chart['name']: chart['status']})
+    releases = {}
+    for chart in json.loads(helm_chart_list_raw or '[]'):
+        releases.update({'{0}/{1}'.format(chart['namespace'], chart['name']): chart})
+
+    inventory = {'updated': time.time(), 'releases': releases, 'invalid': [], 'invalidated': 0}
+    with host_lock(get_cluster_cache_name('releases')):
+        # Releases changed by other processes while helm list was running can't be taken from it
+        previous_inventory = read_cache_file(get_cluster_cache_name('releases') + '.json')
+        if previous_inventory.get('invalidated', 0) >= list_started:
+            inventory['invalid'] = previous_inventory['invalid']
+            inventory['invalidated'] = previous_inventory['invalidated']
+        write_cache_file(get_cluster_cache_name('releases') + '.json', inventory)
+
+    return inventory
+
+
+def read_release_inventory(release_cache_ttl):
+    """
+    Args:
+        release_cache_ttl (int): seconds while release inventory is considered fresh
+    Returns:
+        dict - release inventory, None if inventory is stale
+        bool - True if inventory cache file exists
+    """
+    inventory = read_cache_file(get_cluster_cache_name('releases') + '.json')
+    if 'releases' not in inventory:
+        return None, False
+
+    if time.time() - inventory.get('updated', 0) >= release_cache_ttl:
+        return None, True
+
+    return inventory, True
 
-    return helm_chart_list
 
+def read_inventory_facts(release_inventory, release_cache_ttl):
+    """
+    Args:
+        release_inventory (dict): 'helm_releases' facts gathered by helm_shell_info
+        release_cache_ttl (int): seconds while release inventory is considered fresh
+    Returns:
+        dict - release inventory, None if facts are not set or stale
+    """
+    # Facts are used only on the cluster they were gathered from
+    if not release_inventory or 'releases' not in release_inventory or \
+            release_inventory.get('cluster') != get_kube_identity():
+        return None
+    if time.time() - release_inventory.get('updated', 0) >= release_cache_ttl:
+        return None
+
+    # Releases changed on host after facts were gathered are checked with helm status
+    inventory = {'updated': release_inventory['updated'], 'releases': release_inventory['releases'], 'invalid': []}
+    host_inventory = read_cache_file(get_cluster_cache_name('releases') + '.json')
+    if host_inventory.get('invalidated', 0) >= inventory['updated']:
+        inventory['invalid'] = host_inventory['invalid']
+    return inventory
+
+
+def invalidate_release(chart_deploy_name, chart_namespace):
+    """
+    Args:
+        chart_deploy_name (str): name of chart deployment
+        chart_namespace (str): chart namespace
+    """
+    release_key = '{0}/{1}'.format(chart_namespace, chart_deploy_name)
+    with host_lock(get_cluster_cache_name('releases')):
+        inventory = read_cache_file(get_cluster_cache_name('releases') + '.json')
+        if 'releases' in inventory:
+            if release_key not in inventory['invalid']:
+                inventory['invalid'].append(release_key)
+            inventory['invalidated'] = time.time()
+            write_cache_file(get_cluster_cache_name('releases') + '.json', inventory)
 
+
+def record_deployed_release(release, chart_version, revision):
+    """
+    Args:
+        release (dict): normalized release spec
+        chart_version (str): deployed chart version
+        revision (int): revision of release created by helm_shell, None if release was removed
+    """
+    release_key = '{0}/{1}'.format(release['chart_namespace'], release['chart_deploy_name'])
+    with host_lock(get_cluster_cache_name('deployed')):
+        deployed_state = read_cache_file(get_cluster_cache_name('deployed') + '.json')
+        if revision is None:
+            deployed_state.pop(release_key, None)
+        else:
+            # Local chart is identified by its path in chart cache, which is named by chart digest
+            deployed_state[release_key] = {
+                'revision': str(revision), 'values_digest': release['values_digest'], 'chart_version': chart_version,
+                'chart_location': release['chart_location'] if release['chart_source_type'] == 'local' else ''}
+        write_cache_file(get_cluster_cache_name('deployed') + '.json', deployed_state)
+
+
+def get_recorded_release(deployed_chart):
+    """
+    Args:
+        deployed_chart (dict): 'helm list' chart info of deployed release
+    Returns:
+        dict - state recorded when helm_shell deployed this revision, None if revision wasn't deployed by it
+    """
+    release_key = '{0}/{1}'.format(deployed_chart['namespace'], deployed_chart['name'])
+    recorded = read_cache_file(get_cluster_cache_name('deployed') + '.json').get(release_key)
+    if recorded is None or recorded['revision'] != str(deployed_chart.get('revision')):
+        return None
+    return recorded
+
+
+def is_local_chart_deployed(release, recorded):
+    """
+    Args:
+        release (dict): normalized release spec
+        recorded (dict): state recorded when helm_shell deployed current revision, None if not recorded
+    Returns:
+        bool - True if local chart of release is the one deployed, path in chart cache is named by chart digest
+    """
+    return recorded is not None and recorded['chart_location'] == release['chart_location']
+
+
+def is_chart_deployed(release, deployed_chart, chart_version, recorded):
+    """
+    Args:
+        release (dict): normalized release spec
+        deployed_chart (dict): 'helm list' chart info of deployed release
+        chart_version (str): exact chart version resolved from repo index
+        recorded (dict): state recorded when helm_shell deployed current revision, None if not recorded
+    Returns:
+        bool - True if chart of release is the one deployed
+    """
+    # Local chart is identified by its content only, name and version of task can differ from Chart.yaml
+    if release['chart_source_type'] == 'local':
+        return is_local_chart_deployed(release, recorded)
+    # Version 'latest' can't be compared when it's not resolved with chart index
+    return bool(chart_version) and \
+        deployed_chart.get('chart') == '{0}-{1}'.format(release['chart_name'], chart_version)
+
+
+def check_release_fast(release, deployed_chart, chart_version):
+    """
+    Args:
+        release (dict): normalized release spec
+        deployed_chart (dict): 'helm list' chart info, None if release is not installed
+        chart_version (str): exact chart version resolved from repo index
+    Returns:
+        dict - check mode result, None if deployed state is unknown and helm --dry-run is needed
+    """
+    if deployed_chart is None:
+        return dict(changed=True, failed=False, check_level='fast',
+                    message='Chart {0} would be installed, version {1}'.format(release['chart_deploy_name'],
+                                                                               chart_version or 'latest'))
+
+    # Only revision deployed by helm_shell is known
+    recorded = get_recorded_release(deployed_chart) if deployed_chart['status'] == 'deployed' else None
+    if recorded is None:
+        return None
+    if release['chart_source_type'] != 'local' and not chart_version:
+        return None
+    same_chart = is_chart_deployed(release, deployed_chart, chart_version, recorded)
+
+    if same_chart and recorded['values_digest'] == release['values_digest'] and release['skip_unchanged'] and \
+            not release['force']:
+        return dict(changed=False, failed=False, check_level='fast', chart_version=chart_version,
+                    message='Chart {0} is up to date, version {1}'.format(release['chart_deploy_name'],
+                                                                          chart_version or 'latest'))
+    return dict(changed=True, failed=False, check_level='fast',
+                message='Chart {0} would be upgraded, version {1}'.format(release['chart_deploy_name'],
+                                                                          chart_version or 'latest'))
+
+
+@timed_phase('get_release')
+def get_release(chart_deploy_name, chart_namespace, inventory):
+    """
+    Args:
+        chart_deploy_name (str): name of chart deployment
+        chart_namespace (str): chart namespace
+        inventory (dict): release inventory, None if inventory is stale
+    Returns:
+        dict - 'helm list' chart info, None if release is not installed
+    """
+    release_key = '{0}/{1}'.format(chart_namespace, chart_deploy_name)
+    if inventory is not None and release_key not in inventory['invalid']:
+        return inventory['releases'].get(release_key)
+
+    # Inventory is stale or release was changed since inventory update, ask helm about one release
+    helm_args = ['status', chart_deploy_name, '-n', chart_namespace, '--output', 'json']
+    (_rc, release_status_raw, _err) = run_helm(helm_args)
+    if _rc and 'not found' in _err:
+        return None
+    elif _rc:
+        raise HelmCommandError(format_helm_cmd(helm_args), _err)
+
+    release_status = json.loads(release_status_raw)
+    chart_metadata = release_status.get('chart', {}).get('metadata', {})
+    return {'name': release_status['name'],
+            'namespace': release_status['namespace'],
+            'revision': str(release_status['version']),
+            'status': release_status['info']['status'],
+            'chart': '{0}-{1}'.format(chart_metadata.get('name'), chart_metadata.get('version')),
+            'app_version': chart_metadata.get('appVersion', '')}
+
+
+def get_values_digest(values):
+    """
+    Args:
+        values (dict): chart values
+    Returns:
+        str - sha256 of canonical JSON form of values
+    """
+    def canonical(value):
+        if isinstance(value, dict):
+            return dict((str(key), canonical(item)) for key, item in value.items())
+        if isinstance(value, list):
+            return [canonical(item) for item in value]
+        # Helm returns integral floats as int
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        return value
+
+    content = json.dumps(canonical(values or {}), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+@timed_phase('get_deployed_values')
+def get_deployed_values_digest(chart_deploy_name, chart_namespace):
+    """
+    Args:
+        chart_deploy_name (str): name of chart deployment
+        chart_namespace (str): chart namespace
+    Returns:
+        str - digest of user supplied values of deployed release
+    """
+    helm_args = ['get', 'values', chart_deploy_name, '-n', chart_namespace, '--output', 'json']
+    (_rc, values_raw, _err) = run_helm(helm_args)
+    if _rc:
+        raise HelmCommandError(format_helm_cmd(helm_args), _err)
+
+    return get_values_digest(json.loads(values_raw or 'null'))
+
+
+def is_release_unchanged(release, deployed_chart, chart_version):
+    """
+    Args:
+        release (dict): normalized release spec
+        deployed_chart (dict): 'helm list' chart info of deployed release
+        chart_version (str): exact chart version resolved from repo index
+    Returns:
+        bool - True if deployed chart, version and values match requested
+    """
+    if deployed_chart.get('status') != 'deployed':
+        return False
+
+    # Local chart can change without version bump, its content is known only from path recorded at deploy
+    recorded = get_recorded_release(deployed_chart)
+    if not is_chart_deployed(release, deployed_chart, chart_version, recorded):
+        return False
+
+    # Values of revision deployed by helm_shell are known without helm call
+    if recorded is not None:
+        return recorded['values_digest'] == release['values_digest']
+
+    return get_deployed_values_digest(release['chart_deploy_name'],
+                                      release['chart_namespace']) == release['values_digest']
+
+
+@timed_phase('remove_chart')
 def remove_chart(chart_deploy_name, check_mode, chart_namespace):
     """
     Args:
         chart_deploy_name (str): chart name
         check_mode (bool): run with --dry-run flag
         chart_namespace (str): chart namespace
+    Returns:
+        dict - task result
     """
-    if check_mode is False:
-        _cmd_str = 'helm delete "{0}" -n "{1}"'.format(chart_deploy_name, chart_namespace)
-    else:
-        _cmd_str = 'helm delete "{0}" -n "{1}" --dry-run'.format(chart_deploy_name, chart_namespace)
+    helm_args = ['delete', chart_deploy_name, '-n', chart_namespace]
+    if check_mode:
+        helm_args.append('--dry-run')
 
-    (_rc, remove_chart_output_raw, _err) = module.run_command(_cmd_str, use_unsafe_shell=True)
+    _cmd_str = format_helm_cmd(helm_args)
+    (_rc, remove_chart_output_raw, _err) = run_helm(helm_args)
     if _rc:
-        return module.exit_json(original_message=_err, cmd=_cmd_str, changed=False, failed=True)
+        raise HelmCommandError(_cmd_str, _err)
 
     # Check output and fail task when not find 'deleted message in output'
     if 'uninstalled' in remove_chart_output_raw:
-        result['changed'] = True
-        result['failed'] = False
-        result['message'] = 'Deleted chart {0}'.format(chart_deploy_name)
-        result['original_message'] = remove_chart_output_raw
-        return module.exit_json(**result)
+        return dict(changed=True, failed=False, message='Deleted chart {0}'.format(chart_deploy_name),
+                    original_message=remove_chart_output_raw)
     else:
-        return module.exit_json(original_message='Cant remove chart: {0}'.format(chart_deploy_name), cmd=_cmd_str,
-                                changed=False, failed=True)
+        return dict(original_message='Cant remove chart: {0}'.format(chart_deploy_name), cmd=_cmd_str,
+                    changed=False, failed=True)
 
 
-def check_repo(chart_source_name, chart_location):
+def get_helm_repository_config():
     """
-    Args:
-        chart_source_name (str): chart name
-        chart_location (str): chart remote URL
     Returns:
-        bool
+        str - path to helm repositories.yaml
     """
+    if get_helm_env().get('HELM_REPOSITORY_CONFIG'):
+        return get_helm_env()['HELM_REPOSITORY_CONFIG']
 
-    # Get installed repo list
-    _cmd_str = 'helm repo list -o json'
-    (_rc, repo_list_raw, _err) = module.run_command(_cmd_str, use_unsafe_shell=True)
+    # Default location of helm 3 when 'helm env' is not available
+    if os.environ.get('HELM_REPOSITORY_CONFIG'):
+        return os.environ['HELM_REPOSITORY_CONFIG']
 
-    if 'no repositories to show' in _err:
-        # If no one repo added yes. Add stable
-        _cmd_add_stable_repo = 'helm repo add stable https://kubernetes-charts.storage.googleapis.com'
-        (_rc, repo_list_raw, _err) = module.run_command(_cmd_add_stable_repo, use_unsafe_shell=True)
-
-        if _rc:
-            return module.exit_json(original_message=_err, cmd=_cmd_add_stable_repo, changed=False, failed=True)
-
-        # And rerun repo list
-        (_rc, repo_list_raw, _err) = module.run_command(_cmd_str, use_unsafe_shell=True)
+    if sys.platform == 'darwin':
+        config_home = os.path.expanduser('~/Library/Preferences')
+    else:
+        config_home = os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config')
+    return os.path.join(config_home, 'helm', 'repositories.yaml')
 
-    if _rc:
-        return module.exit_json(original_message=_err, cmd=_cmd_str, changed=False, failed=True)
 
-    repo_list = json.loads(repo_list_raw)
+def normalize_repo_url(repo_url):
+    """
+    Args:
+        repo_url (str): chart repo URL
+    Returns:
+        str - URL with lower case scheme and host and without trailing slash
+    """
+    url_parts = urlsplit(repo_url.strip())
+    return urlunsplit((url_parts.scheme.lower(), url_parts.netloc.lower(), url_parts.path.rstrip('/'),
+                       url_parts.query, ''))
 
-    # Check if repo already added
-    for repo in repo_list:
-        if chart_source_name in repo['name'] and chart_location in repo['url']:
-            return True
 
-    return False
+def parse_repository_config(repository_config):
+    """
+    Args:
+        repository_config (str): content of helm repositories.yaml
+    Returns:
+        list of repo dicts with name and url
+    """
+    if HAS_YAML:
+        return (yaml.load(repository_config, Loader=YamlLoader) or {}).get('repositories') or []
+
+    # Without PyYAML parse flat list of repositories written by helm
+    repositories = []
+    in_repositories = False
+    for line in repository_config.splitlines():
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        if not line[0].isspace() and not line.startswith('-'):
+            in_repositories = line.startswith('repositories:')
+            continue
+        if not in_repositories:
+            continue
+        if line.lstrip().startswith('- '):
+            repositories.append({})
+            line = line.replace('- ', '  ', 1)
+        if repositories and ':' in line:
+            key, value = line.strip().split(':', 1)
+            repositories[-1][key.strip()] = value.strip().strip('"\'')
+    return repositories
+
+
+def get_repo_registry():
+    """
+    Returns:
+        dict - configured repos indexed by exact name and normalized URL
+    """
+    repository_config = get_helm_repository_config()
+    try:
+        config_stat = os.stat(repository_config)
+        registry_key = (repository_config, config_stat.st_mtime, config_stat.st_size)
+    except OSError:
+        registry_key = (repository_config, None, None)
+
+    with repo_registry_lock:
+        if repo_registry['key'] == registry_key:
+            return repo_registry
+
+        repositories = []
+        if registry_key[1] is not None:
+            with open(repository_config, 'r') as _file:
+                repositories = parse_repository_config(_file.read())
+
+        repo_registry['key'] = registry_key
+        repo_registry['names'] = dict((repo['name'], repo) for repo in repositories if repo.get('name'))
+        repo_registry['urls'] = dict((normalize_repo_url(repo['url']), repo) for repo in repositories
+                                     if repo.get('url'))
+        return repo_registry
+
+
+@timed_phase('check_repo')
+def check_repo(chart_source_name, chart_location):
+    """
+    Args:
+        chart_source_name (str): chart repo name
+        chart_location (str): chart remote URL
+    Returns:
+        bool
+    """
+    # Check if repo already added with the same name and URL
+    repo = get_repo_registry()['names'].get(chart_source_name)
+    return repo is not None and normalize_repo_url(repo.get('url', '')) == normalize_repo_url(chart_location)
 
 
-def update_repo():
+@timed_phase('update_repo')
+def update_repo(chart_source_name, chart_location, repo_cache_ttl):
     """
+    Args:
+        chart_source_name (str): chart repo name
+        chart_location (str): chart repo remote URL
+        repo_cache_ttl (int): seconds while repo index is considered fresh
     Returns:
-        bool
+        bool - update status
+        bool - True if repo index was fresh and update was skipped
     """
-    # Update repo
-    _cmd_str = 'helm repo update'
-    (_rc, update_repo_output_raw, _err) = module.run_command(_cmd_str, use_unsafe_shell=True)
-    if _rc:
-        return module.exit_json(original_message=_err, cmd=_cmd_str, changed=False, failed=True)
+    repo_key = '{0}|{1}'.format(chart_source_name, chart_location)
+    repo_cache = read_cache_file('repo_index.json')
+
+    # Skip update if repo index is still fresh
+    if time.time() - repo_cache.get(repo_key, 0) < repo_cache_ttl:
+        return True, True
+
+    # Only one process updates repo, others wait for it and use index it downloaded
+    wait_started = time.time()
+    with host_lock('repo-' + chart_source_name):
+        repo_cache = read_cache_file('repo_index.json')
+        if repo_cache.get(repo_key, 0) >= wait_started or time.time() - repo_cache.get(repo_key, 0) < repo_cache_ttl:
+            return True, True
+
+        # Update only required repo, helm before 3.7 updates all repos only
+        helm_args = ['repo', 'update', chart_source_name]
+        (_rc, update_repo_output_raw, _err) = run_helm(helm_args)
+        if _rc and 'accepts no arguments' in _err:
+            helm_args = ['repo', 'update']
+            (_rc, update_repo_output_raw, _err) = run_helm(helm_args)
+        if _rc:
+            raise HelmCommandError(format_helm_cmd(helm_args), _err)
 
-    for line in update_repo_output_raw.splitlines():
-        if 'Update Complete.' in line:
-            return True
+        for line in update_repo_output_raw.splitlines():
+            if 'Update Complete.' in line:
+                mark_repo_updated(chart_source_name, chart_location)
+                return True, False
 
-    return False
+    return False, False
 
 
+def mark_repo_updated(chart_source_name, chart_location):
+    """
+    Args:
+        chart_source_name (str): chart repo name
+        chart_location (str): chart repo remote URL
+    """
+    with host_lock('repo_index'):
+        repo_cache = read_cache_file('repo_index.json')
+        repo_cache.update({'{0}|{1}'.format(chart_source_name, chart_location): time.time()})
+        write_cache_file('repo_index.json', repo_cache)
+
+
+@timed_phase('add_repo')
 def add_repo(repo_source_name, repo_location, repo_username, repo_password):
     """
     Args:
@@ -295,122 +1603,1006 @@ def add_repo(repo_source_name, repo_location, repo_username, repo_password):
     Returns:
         bool
     """
+    # Password is passed on stdin, so it's not visible in process list
+    helm_args = ['repo', 'add', repo_source_name, repo_location]
+    password_data = None
     if repo_username != "":
-        _cmd_str = 'helm repo add --username {0} --password {1} {2} {3}'.format(repo_username, repo_password,
-                                                                                repo_source_name, repo_location)
-    else:
-        _cmd_str = 'helm repo add {0} {1}'.format(repo_source_name, repo_location)
-    (_rc, _out, _err) = module.run_command(_cmd_str, use_unsafe_shell=True)
+        helm_args += ['--username', repo_username, '--password-stdin']
+        password_data = repo_password
+    (_rc, _out, _err) = run_helm(helm_args, data=password_data)
     if _rc:
-        return module.exit_json(original_message=_err, cmd=_cmd_str, changed=False, failed=True)
+        raise HelmCommandError(format_helm_cmd(helm_args), _err)
 
     if check_repo(repo_source_name, repo_location):
+        # 'helm repo add' downloads fresh index
+        mark_repo_updated(repo_source_name, repo_location)
         return True
     else:
         return False
 
 
-def run_module():
-    chart_namespace = module.params['namespace']
-    chart_create_namespace = module.params['create_namespace']
-    chart_state = module.params['state']
-    chart_name = module.params['name']
-    chart_deploy_name = module.params['chart_deploy_name']
-    chart_location = module.params['source']['location']
-    chart_source_type = module.params['source']['type']
-    chart_source_username = module.params['source']['username']
-    chart_source_password = module.params['source']['password']
-    values_file = module.params['values_file']
-    force = module.params['force']
-    chart_version = module.params['version']
-    chart_source_name = module.params['source']['name'] if chart_source_type == 'repo' else ''
-    chart_wait = module.params['wait']
-    chart_timeout = module.params['timeout']
-
-    # Get chart lists
-    helm_charts_list = get_chart_lists(chart_namespace)
+def get_helm_repository_cache():
+    """
+    Returns:
+        str - path to directory with helm repo indexes
+    """
+    if get_helm_env().get('HELM_REPOSITORY_CACHE'):
+        return get_helm_env()['HELM_REPOSITORY_CACHE']
 
-    # Remove chart if state 'absent'
-    if chart_state == 'absent':
-        if chart_deploy_name in helm_charts_list:
-            remove_chart(chart_deploy_name, module.check_mode, chart_namespace)
-        elif chart_deploy_name not in helm_charts_list:
-            result['changed'] = False
-            result['failed'] = False
-            result['message'] = 'Chart with name "{0}" already is not installed'.format(chart_deploy_name)
-            remove_tmp_folder(values_file)
-            return module.exit_json(**result)
+    # Default location of helm 3 when 'helm env' is not available
+    if os.environ.get('HELM_REPOSITORY_CACHE'):
+        return os.environ['HELM_REPOSITORY_CACHE']
 
-    # Add/update remote repository
-    if chart_source_type == 'repo' and check_repo(chart_source_name, chart_location) is False:
-        if add_repo(chart_source_name, chart_location, chart_source_username, chart_source_password) is False:
-            remove_tmp_folder(values_file)
-            return module.exit_json(msg='Cant add chart repo with name: %s' % chart_source_name, changed=False,
-                                    failed=True)
+    if sys.platform == 'darwin':
+        cache_home = os.path.expanduser('~/Library/Caches')
+    else:
+        cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'helm', 'repository')
 
-    if update_repo() is False:
-        remove_tmp_folder(values_file)
-        return module.exit_json(msg='Cant upgrade chart repo with name: %s' % chart_source_name, changed=False,
-                                failed=True)
+
+def iter_repo_index(index_path):
+    """
+    Args:
+        index_path (str): path to helm repo index.yaml
+    Returns:
+        generator of (chart name, version, digest, created) tuples
+    """
+    chart_indent = None
+    dash_indent = None
+    chart_name = None
+    chart_entry = None
+
+    # Read index line by line, only entries keys of chart versions are parsed
+    with open(index_path, 'r') as _file:
+        for line in _file:
+            stripped = line.strip()
+            if not stripped or stripped.startswith('#'):
+                continue
+            indent = len(line) - len(line.lstrip(' '))
+
+            # Top level key, entries are finished or not started yet
+            if indent == 0 and not stripped.startswith('-'):
+                if chart_entry and chart_entry.get('version'):
+                    yield chart_name, chart_entry['version'], chart_entry.get('digest', ''), \
+                        chart_entry.get('created', '')
+                chart_entry = None
+                chart_indent = -1 if stripped.startswith('entries:') else None
+                continue
+            if chart_indent is None:
+                continue
+            if chart_indent == -1:
+                chart_indent = indent
+
+            # Chart name key, versions follow as list items
+            if indent == chart_indent and not stripped.startswith('-'):
+                if chart_entry and chart_entry.get('version'):
+                    yield chart_name, chart_entry['version'], chart_entry.get('digest', ''), \
+                        chart_entry.get('created', '')
+                chart_name = stripped.rstrip(':').strip('"\'')
+                chart_entry = None
+                dash_indent = None
+                continue
+
+            # New chart version
+            if stripped.startswith('- ') and (dash_indent is None or indent == dash_indent):
+                if chart_entry and chart_entry.get('version'):
+                    yield chart_name, chart_entry['version'], chart_entry.get('digest', ''), \
+                        chart_entry.get('created', '')
+                dash_indent = indent
+                chart_entry = {}
+                stripped = stripped[2:].strip()
+                indent += 2
+            if chart_entry is None or indent != dash_indent + 2 or ':' not in stripped:
+                continue
+
+            key, value = stripped.split(':', 1)
+            if key in ['version', 'digest', 'created']:
+                chart_entry[key] = value.strip().strip('"\'')
+
+    if chart_entry and chart_entry.get('version'):
+        yield chart_name, chart_entry['version'], chart_entry.get('digest', ''), chart_entry.get('created', '')
+
+
+def get_chart_index(chart_source_name):
+    """
+    Args:
+        chart_source_name (str): chart repo name
+    Returns:
+        str - path to compact chart index of repo, None if helm has no cached index
+    """
+    source_path = os.path.join(get_helm_repository_cache(), '{0}-index.yaml'.format(chart_source_name))
+    try:
+        source_stat = os.stat(source_path)
+    except OSError:
+        return None
+
+    # First line of compact index tells which source index it was built from
+    source_line = '# {0}\t{1}\t{2}\n'.format(source_path, source_stat.st_mtime, source_stat.st_size)
+    index_dir = os.path.join(module.params['cache_dir'], 'chart_index')
+    index_path = os.path.join(index_dir, '{0}.tsv'.format(chart_source_name))
+
+    # Index is built by one process, others wait and use it
+    with host_lock('chart_index-' + chart_source_name):
+        try:
+            with open(index_path, 'r') as _file:
+                if _file.readline() == source_line:
+                    return index_path
+        except (IOError, OSError):
+            pass
+
+        # Source index is changed, build new compact index without loading YAML into memory
+        try:
+            if not os.path.isdir(index_dir):
+                os.makedirs(index_dir)
+            tmp_fd, tmp_path = tempfile.mkstemp(dir=index_dir)
+            with os.fdopen(tmp_fd, 'w') as _file:
+                _file.write(source_line)
+                for chart_version in iter_repo_index(source_path):
+                    _file.write('\t'.join(chart_version) + '\n')
+            os.rename(tmp_path, index_path)
+        except (IOError, OSError) as err:
+            module.warn('Cant build chart index of repo {0}. Reason: {1}'.format(chart_source_name, str(err)))
+            return None
+
+    return index_path
+
+
+def parse_semver(version):
+    """
+    Args:
+        version (str): semantic version
+    Returns:
+        tuple - sort key of version, None if version is not valid
+    """
+    version = version.strip()
+    if version.startswith('v'):
+        version = version[1:]
+    core, _, prerelease = version.split('+', 1)[0].partition('-')
+    parts = core.split('.')
+    if len(parts) != 3 or not all(part.isdigit() for part in parts):
+        return None
+
+    # Release is newer than any of its prereleases
+    if not prerelease:
+        return int(parts[0]), int(parts[1]), int(parts[2]), 1, ()
+    identifiers = tuple((0, int(part), '') if part.isdigit() else (1, 0, part) for part in prerelease.split('.'))
+    return int(parts[0]), int(parts[1]), int(parts[2]), 0, identifiers
+
+
+def parse_version_constraint(version_constraint):
+    """
+    Args:
+        version_constraint (str): helm version constraint e.g. '~1.2', '>=1.0.0 <2.0.0' or '1.x || ^2.1'
+    Returns:
+        list of (list of predicates, bool - prereleases allowed) alternatives, None if constraint is not valid
+    """
+    alternatives = []
+    for constraint in version_constraint.split('||'):
+        # Hyphen range '1.2 - 1.4.5'
+        constraint = re.sub(r'(\S+)\s+-\s+(\S+)', r'>=\1,<=\2', constraint.strip())
+        predicates = []
+        prerelease = False
+        for operator, version in re.findall(r'(!=|>=|=>|<=|=<|~>|\^|~|>|<|=)?\s*([^\s,<>=!~^]+)', constraint):
+            core, _, version_prerelease = version.lstrip('v').split('+', 1)[0].partition('-')
+            prerelease = prerelease or bool(version_prerelease)
+            parts = []
+            for part in core.split('.'):
+                if part in ['x', 'X', '*']:
+                    break
+                if not part.isdigit():
+                    return None
+                parts.append(int(part))
+            if len(parts) > 3:
+                return None
+            predicates.extend(get_version_predicates(operator, parts, version_prerelease))
+        alternatives.append((predicates, prerelease))
+    return alternatives
+
+
+def get_version_predicates(operator, parts, prerelease):
+    """
+    Args:
+        operator (str): constraint operator
+        parts (list): numeric parts of constraint version, missing parts are wildcards
+        prerelease (str): prerelease of constraint version
+    Returns:
+        list of functions which check version sort key
+    """
+    exact = len(parts) == 3
+    lower = parse_semver('.'.join(str(part) for part in (parts + [0, 0, 0])[:3]) +
+                         ('-' + prerelease if prerelease and exact else ''))
+
+    def bump(position):
+        bumped = (parts + [0, 0, 0])[:3]
+        bumped[position] += 1
+        return tuple(bumped[:position + 1] + [0] * (2 - position)) + (0, ((0, 0, ''),))
+
+    # Upper bound of wildcard version e.g. '1.2' is '<1.3.0-0'
+    upper = bump(len(parts) - 1) if parts and not exact else None
+
+    if operator in ['', '=']:
+        if exact:
+            return [lambda key: key == lower]
+        return [lambda key: key >= lower] + ([lambda key: key < upper] if upper else [])
+    if operator == '!=':
+        if exact:
+            return [lambda key: key != lower]
+        return [lambda key: key < lower or (upper is not None and key >= upper)] if parts else [lambda key: False]
+    if operator == '>':
+        return [lambda key: key > lower] if exact else [lambda key: upper is not None and key >= upper]
+    if operator in ['>=', '=>']:
+        return [lambda key: key >= lower]
+    if operator == '<':
+        return [lambda key: key < lower]
+    if operator in ['<=', '=<']:
+        return [lambda key: key <= lower] if exact else [lambda key: upper is None or key < upper]
+    if operator in ['~', '~>']:
+        if not parts:
+            return []
+        return [lambda key: key >= lower, lambda key, _upper=bump(min(len(parts), 2) - 1): key < _upper]
+
+    # Caret allows changes which don't modify left-most non-zero part
+    if not parts:
+        return []
+    position = 0
+    while position < len(parts) - 1 and parts[position] == 0:
+        position += 1
+    return [lambda key: key >= lower, lambda key, _upper=bump(position): key < _upper]
+
+
+def match_chart_version(version_constraint, chart_versions):
+    """
+    Args:
+        version_constraint (str): exact version or constraint, empty for latest
+        chart_versions (list): (version, digest, created) tuples of chart
+    Returns:
+        tuple - best matching (version, digest, created), None if nothing matches
+    """
+    if not version_constraint or version_constraint == 'latest':
+        version_constraint = '*'
+
+    # Exact version is never changed
+    if parse_semver(version_constraint) is not None:
+        for chart_version in chart_versions:
+            if chart_version[0] == version_constraint:
+                return chart_version
+        return None
+
+    alternatives = parse_version_constraint(version_constraint)
+    if alternatives is None:
+        return None
+
+    best_match = None
+    best_key = None
+    for chart_version in chart_versions:
+        version_key = parse_semver(chart_version[0])
+        if version_key is None:
+            continue
+        for predicates, prerelease in alternatives:
+            # Prereleases match only when constraint has prerelease
+            if version_key[3] == 0 and not prerelease:
+                continue
+            if all(predicate(version_key) for predicate in predicates):
+                if best_key is None or version_key > best_key:
+                    best_match, best_key = chart_version, version_key
+                break
+    return best_match
+
+
+@timed_phase('resolve_version')
+def resolve_chart_version(release):
+    """
+    Args:
+        release (dict): normalized release spec
+    Returns:
+        str - exact chart version, requested version if it can't be resolved with cached repo index
+        str - chart digest from repo index, None if version is not resolved
+    """
+    if release['chart_source_type'] != 'repo':
+        return release['chart_version'], None
+
+    index_path = get_chart_index(release['chart_source_name'])
+    if index_path is None:
+        return release['chart_version'], None
+
+    # Versions of one chart are grouped together in index
+    chart_prefix = release['chart_name'] + '\t'
+    chart_versions = []
+    with open(index_path, 'r') as _file:
+        for line in _file:
+            if line.startswith(chart_prefix):
+                chart_versions.append(tuple(line.rstrip('\n').split('\t')[1:]))
+            elif chart_versions:
+                break
+
+    chart_version = match_chart_version(release['chart_version'], chart_versions)
+    if chart_version is None:
+        # Helm reports missing chart or version with its own error
+        return release['chart_version'], None
+    return chart_version[0], chart_version[1]
+
+
+def get_release_spec(params, defaults=None):
+    """
+    Args:
+        params (dict): release options in module_args format
+        defaults (dict): module params used for options not set in release
+    Returns:
+        dict - normalized release spec
+    """
+    defaults = defaults or {}
+
+    def param(key):
+        return params[key] if params.get(key) is not None else defaults.get(key)
+
+    source = params['source']
+    chart_source_type = source['type']
+    return dict(
+        chart_name=params['name'],
+        chart_deploy_name=params['chart_deploy_name'],
+        chart_namespace=param('namespace'),
+        chart_create_namespace=param('create_namespace'),
+        chart_state=param('state'),
+        chart_location=source['location'],
+        chart_source_type=chart_source_type,
+        chart_source_username=source.get('username') or '',
+        chart_source_password=source.get('password') or '',
+        chart_source_name=source['name'] if chart_source_type == 'repo' else '',
+        chart_files=source.get('files') or [],
+        values_file=param('values_file') or '',
+        values=params.get('values'),
+        force=param('force'),
+        chart_version=params.get('version'),
+        chart_wait=param('wait'),
+        chart_wait_mode=param('wait_mode'),
+        chart_timeout=param('timeout'),
+        history_max=param('history_max'),
+        values_digest=param('values_digest') or get_values_digest({}),
+        skip_unchanged=param('skip_unchanged'),
+        depends_on=params.get('depends_on') or [],
+        rendered_manifest_file=params.get('rendered_manifest_file'),
+        rendered_manifest_digest=params.get('rendered_manifest_digest') or '',
+        kube_context='',
+        kubeconfig=''
+    )
+
+
+def expand_kube_contexts(releases, kube_contexts):
+    """
+    Args:
+        releases (list): normalized release specs
+        kube_contexts (list): kube contexts with name and kubeconfig
+    Returns:
+        list - release specs for every kube context
+    """
+    return [dict(release, kube_context=context['name'], kubeconfig=context.get('kubeconfig') or '')
+            for context in kube_contexts for release in releases]
+
+
+def get_release_label(release):
+    """
+    Args:
+        release (dict): normalized release spec or release result
+    Returns:
+        str - release name with kube context in messages
+    """
+    if release.get('kube_context'):
+        return '{0}@{1}'.format(release['chart_deploy_name'], release['kube_context'])
+    return release['chart_deploy_name']
+
+
+def prepare_repos(releases, repo_cache_ttl):
+    """
+    Args:
+        releases (list): normalized release specs
+        repo_cache_ttl (int): seconds while repo index is considered fresh
+    Returns:
+        dict - repo_cache_hit status for every (repo name, repo URL)
+    """
+    repo_cache_hits = {}
+    for release in releases:
+        if release['chart_state'] == 'absent' or release['chart_source_type'] != 'repo':
+            continue
+
+        repo_key = (release['chart_source_name'], release['chart_location'])
+        if repo_key in repo_cache_hits:
+            continue
+
+        # Add remote repository, repositories.yaml is changed by one process at a time
+        if check_repo(*repo_key) is False:
+            with host_lock('repositories'):
+                # Repo could be added by other process while this one was waiting
+                if check_repo(*repo_key) is False and add_repo(
+                        release['chart_source_name'], release['chart_location'], release['chart_source_username'],
+                        release['chart_source_password']) is False:
+                    raise HelmCommandError('', 'Cant add chart repo with name: %s' % release['chart_source_name'])
+
+        # Update remote repository
+        (repo_updated, repo_cache_hits[repo_key]) = update_repo(release['chart_source_name'],
+                                                                release['chart_location'], repo_cache_ttl)
+        if repo_updated is False:
+            raise HelmCommandError('', 'Cant upgrade chart repo with name: %s' % release['chart_source_name'])
+
+    return repo_cache_hits
+
+
+def deploy_release(release, inventory, check_mode):
+    """
+    Args:
+        release (dict): normalized release spec
+        inventory (dict): release inventory, None if inventory is stale
+        check_mode (bool): run helm with --dry-run flag
+    Returns:
+        dict - task result for release
+    """
+    chart_deploy_name = release['chart_deploy_name']
+    deployed_chart = get_release(chart_deploy_name, release['chart_namespace'], inventory)
+
+    # Remove chart if state 'absent'
+    if release['chart_state'] == 'absent':
+        if deployed_chart is not None:
+            deployed_manifest = get_deployed_manifest(chart_deploy_name, release['chart_namespace']) \
+                if module._diff else None
+            if not check_mode:
+                invalidate_release(chart_deploy_name, release['chart_namespace'])
+            remove_result = remove_chart(chart_deploy_name, check_mode, release['chart_namespace'])
+            if not check_mode and not remove_result['failed']:
+                record_deployed_release(release, None, None)
+            if deployed_manifest is not None and not remove_result['failed']:
+                remove_result['diff'] = get_manifest_diff(deployed_manifest, '')[0]
+            return remove_result
+        return dict(changed=False, failed=False,
+                    message='Chart with name "{0}" already is not installed'.format(chart_deploy_name))
+
+    # Pin version, so constraint or latest can be compared with deployed chart
+    (chart_version, chart_digest) = resolve_chart_version(release)
+
+    # Fast check mode compares request with state recorded at deploy, helm is called only when state is unknown
+    if check_mode and module.params['check_level'] == 'fast' and not module._diff and \
+            release['rendered_manifest_file'] is None:
+        release_result = check_release_fast(release, deployed_chart, chart_version)
+        if release_result is not None:
+            return release_result
+
+    # Manifest rendered on controller is compared with deployed one instead of rendering chart on host
+    deployed_manifest = None
+    if release['rendered_manifest_digest'] and deployed_chart is not None and \
+            deployed_chart['status'] == 'deployed':
+        deployed_manifest = get_deployed_manifest(chart_deploy_name, release['chart_namespace'])
+
+    # Check mode with rendered manifest doesn't need chart and --dry-run
+    if check_mode and release['rendered_manifest_file'] is not None:
+        # Render is uploaded as file, so it's never echoed in module args or logged on the host
+        try:
+            with open(release['rendered_manifest_file'], 'r') as _file:
+                rendered_manifest = _file.read()
+        except (IOError, OSError) as err:
+            raise HelmCommandError('', 'Cant read manifest rendered on controller. Reason: {0}'.format(str(err)))
+        if deployed_manifest is None and deployed_chart is not None:
+            deployed_manifest = get_deployed_manifest(chart_deploy_name, release['chart_namespace'])
+        (diff, resource_changes) = get_manifest_diff(deployed_manifest or '', rendered_manifest)
+        if deployed_chart is not None and deployed_chart['status'] == 'deployed' and release['skip_unchanged'] and \
+                not release['force'] and not any(resource_changes.values()) and \
+                is_chart_deployed(release, deployed_chart, chart_version, get_recorded_release(deployed_chart)):
+            return dict(changed=False, failed=False, chart_version=chart_version,
+                        message='Chart {0} is up to date, version {1}'.format(chart_deploy_name,
+                                                                              chart_version or 'latest'))
+        original_message = get_manifest_report(rendered_manifest, module.params['return_manifest'])
+        original_message['resource_changes'] = resource_changes
+        release_result = dict(changed=True, failed=False, original_message=original_message,
+                              message='Chart {0} would be {1}, version {2}'.format(
+                                  chart_deploy_name, 'installed' if deployed_chart is None else 'upgraded',
+                                  chart_version))
+        if module._diff:
+            release_result['diff'] = diff
+        return release_result
+
+    # Chart directory uploaded as files is packaged once per content
+    if release['chart_files'] and not os.path.exists(release['chart_location']):
+        package_chart(release['chart_location'], release['chart_files'])
+
+    install_args = dict(chart_deploy_name=chart_deploy_name, chart_source_name=release['chart_source_name'],
+                        chart_name=release['chart_name'], chart_namespace=release['chart_namespace'],
+                        chart_version=chart_version, values_file=release['values_file'], values=release['values'],
+                        chart_source_type=release['chart_source_type'], chart_location=release['chart_location'],
+                        check_mode=check_mode, force=release['force'],
+                        chart_create_namespace=release['chart_create_namespace'],
+                        chart_wait=release['chart_wait'], chart_timeout=release['chart_timeout'],
+                        history_max=release['history_max'],
+                        return_manifest=module.params['return_manifest'], diff_mode=module._diff,
+                        async_wait=release['chart_wait'] and release['chart_wait_mode'] == 'async' and not check_mode)
+
+    # Chart exist with same version and values or same rendered manifest, nothing to upgrade
+    if deployed_chart is not None and deployed_chart['status'] != 'DELETED' and release['skip_unchanged'] and \
+            not release['force']:
+        if release['rendered_manifest_digest']:
+            unchanged = deployed_manifest is not None and \
+                get_manifest_resources_digest(deployed_manifest) == release['rendered_manifest_digest'] and \
+                is_chart_deployed(release, deployed_chart, chart_version, get_recorded_release(deployed_chart))
+        else:
+            unchanged = is_release_unchanged(release, deployed_chart, chart_version)
+        if unchanged:
+            return dict(changed=False, failed=False, chart_version=chart_version,
+                        message='Chart {0} is up to date, version {1}'.format(chart_deploy_name,
+                                                                              chart_version or 'latest'))
+
+    # Deployed manifest is the 'before' side of diff
+    if module._diff and deployed_chart is not None and not install_args['async_wait']:
+        install_args['deployed_manifest'] = deployed_manifest if deployed_manifest is not None else \
+            get_deployed_manifest(chart_deploy_name, release['chart_namespace'])
+
+    # Release is changed by this task, inventory can't be used for it anymore
+    if not check_mode:
+        invalidate_release(chart_deploy_name, release['chart_namespace'])
 
     # Chart doesn't exist first time, install
-    if chart_deploy_name not in helm_charts_list:
-        (ex_result, msg, diff, status, cmd_str) = install_chart(install_type='install', replace=False,
-                                                                chart_deploy_name=chart_deploy_name,
-                                                                chart_source_name=chart_source_name,
-                                                                chart_name=chart_name, chart_namespace=chart_namespace,
-                                                                chart_version=chart_version, values_file=values_file,
-                                                                chart_source_type=chart_source_type,
-                                                                chart_location=chart_location,
-                                                                check_mode=module.check_mode,
-                                                                force=force,
-                                                                chart_create_namespace=chart_create_namespace,
-                                                                chart_wait=chart_wait, chart_timeout=chart_timeout)
+    if deployed_chart is None:
+        (ex_result, msg, diff, status, cmd_str) = install_chart(install_type='install', replace=False, **install_args)
     # Chart exist, but in status 'DELETED', reinstall
-    elif chart_deploy_name in helm_charts_list and helm_charts_list[chart_deploy_name] == 'DELETED':
-        (ex_result, msg, diff, status, cmd_str) = install_chart(install_type='install', replace=True,
-                                                                chart_deploy_name=chart_deploy_name,
-                                                                chart_source_name=chart_source_name,
-                                                                chart_name=chart_name, chart_namespace=chart_namespace,
-                                                                chart_version=chart_version, values_file=values_file,
-                                                                chart_source_type=chart_source_type,
-                                                                chart_location=chart_location,
-                                                                check_mode=module.check_mode,
-                                                                force=force,
-                                                                chart_create_namespace=chart_create_namespace,
-                                                                chart_wait=chart_wait, chart_timeout=chart_timeout)
+    elif deployed_chart['status'] == 'DELETED':
+        (ex_result, msg, diff, status, cmd_str) = install_chart(install_type='install', replace=True, **install_args)
     # Chart exist, but in status 'DEPLOYED', upgrade
     else:
-        (ex_result, msg, diff, status, cmd_str) = install_chart(install_type='upgrade',
-                                                                chart_deploy_name=chart_deploy_name,
-                                                                chart_source_name=chart_source_name,
-                                                                chart_name=chart_name, chart_namespace=chart_namespace,
-                                                                chart_version=chart_version, values_file=values_file,
-                                                                chart_source_type=chart_source_type,
-                                                                chart_location=chart_location,
-                                                                check_mode=module.check_mode,
-                                                                force=force,
-                                                                chart_create_namespace=chart_create_namespace,
-                                                                chart_wait=chart_wait, chart_timeout=chart_timeout)
+        (ex_result, msg, diff, status, cmd_str) = install_chart(install_type='upgrade', **install_args)
+
+    # Release readiness is checked later by 'jobs' poll
+    if status == 'submitted':
+        return dict(changed=True, failed=False, job=msg['job'], cmd=cmd_str,
+                    message='Submitted chart {0}, wait for it with jobs poll'.format(chart_deploy_name))
+
     # Change task status
     if ex_result:
-        chart_version = 'latest' if chart_version is False else chart_version
-        result['changed'] = True
-        result['failed'] = False
-        result['message'] = 'Installed chart {0}, version {1}'.format(chart_deploy_name, chart_version)
-        result['original_message'] = msg
-        result['diff'] = diff
-        result['cmd'] = cmd_str
+        if not check_mode and 'version' in msg:
+            record_deployed_release(release, chart_version, msg['version'])
+        chart_version = 'latest' if not chart_version else chart_version
+        release_result = dict(changed=True, failed=False,
+                              message='Installed chart {0}, version {1}'.format(chart_deploy_name, chart_version),
+                              original_message=msg, cmd=cmd_str)
+        if chart_digest:
+            release_result.update({'chart_version': chart_version, 'chart_digest': chart_digest})
+        if diff is not None:
+            release_result['diff'] = diff
+        return release_result
+    else:
+        return dict(msg='Chart {0} is not installed'.format(chart_deploy_name), original_message=msg, cmd=cmd_str,
+                    changed=False, failed=True)
+
+
+def run_release(release, inventory, check_mode):
+    """
+    Args:
+        release (dict): normalized release spec
+        inventory (dict): release inventory
+        check_mode (bool): run helm with --dry-run flag
+    Returns:
+        dict - task result for release, helm errors are returned as failed result
+    """
+    try:
+        with kube_context(release['kube_context'], release['kubeconfig']):
+            release_result = deploy_release(release, inventory, check_mode)
+    except HelmCommandError as err:
+        release_result = dict(original_message=err.err, cmd=err.cmd, changed=False, failed=True)
+
+    release_result.update({'chart_deploy_name': release['chart_deploy_name'],
+                           'namespace': release['chart_namespace']})
+    if release['kube_context']:
+        release_result['kube_context'] = release['kube_context']
+    return release_result
+
+
+def get_release_graph_error(releases):
+    """
+    Args:
+        releases (list): normalized release specs
+    Returns:
+        str - error message, None if all dependencies are releases of the same task
+    """
+    # Dependencies are resolved inside of the same kube context
+    release_names = [(release['kube_context'], release['chart_deploy_name']) for release in releases]
+    for release in releases:
+        if not release['depends_on']:
+            continue
+        if release_names.count((release['kube_context'], release['chart_deploy_name'])) > 1:
+            return 'Release {0} with depends_on must have unique chart_deploy_name'.format(
+                release['chart_deploy_name'])
+        for dependency in release['depends_on']:
+            if release_names.count((release['kube_context'], dependency)) != 1:
+                return 'Release {0} depends on {1}, which must be one release of the same task'.format(
+                    release['chart_deploy_name'], dependency)
+    return None
+
+
+def schedule_releases(releases, max_workers, check_mode, inventories):
+    """
+    Args:
+        releases (list): normalized release specs
+        max_workers (int): max number of releases deployed at the same time
+        check_mode (bool): run helm with --dry-run flag
+        inventories (dict): release inventory of every (kube context, kubeconfig)
+    Returns:
+        list - task results in the same order as releases
+    """
+    release_indexes = dict(((release['kube_context'], release['chart_deploy_name']), index)
+                           for index, release in enumerate(releases))
+    dependents = dict((index, []) for index in range(len(releases)))
+    waiting = {}
+    for index, release in enumerate(releases):
+        waiting[index] = set(release['depends_on'])
+        for dependency in release['depends_on']:
+            dependents[release_indexes[(release['kube_context'], dependency)]].append(index)
+
+    release_results = [None] * len(releases)
+
+    def cancelled_result(index, reason):
+        cancelled = dict(msg=reason, changed=False, failed=True, cancelled=True,
+                         chart_deploy_name=releases[index]['chart_deploy_name'],
+                         namespace=releases[index]['chart_namespace'])
+        if releases[index]['kube_context']:
+            cancelled['kube_context'] = releases[index]['kube_context']
+        return cancelled
+
+    def cancel(index, reason):
+        # Cancel release and everything which depends on it
+        if release_results[index] is not None:
+            return
+        waiting.pop(index, None)
+        release_results[index] = cancelled_result(index, reason)
+        for dependent in dependents[index]:
+            cancel(dependent, 'Cancelled, release {0} failed'.format(releases[index]['chart_deploy_name']))
+
+    # Release is started as soon as all its dependencies are deployed
+    executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+    running = {}
+    try:
+        ready = [index for index in range(len(releases)) if not waiting[index]]
+        while ready or running:
+            for index in ready:
+                del waiting[index]
+                inventory = inventories[(releases[index]['kube_context'], releases[index]['kubeconfig'])]
+                running[executor.submit(run_release, releases[index], inventory, check_mode)] = index
+            ready = []
+
+            (done, _) = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                index = running.pop(future)
+                release_results[index] = future.result()
+                for dependent in dependents[index]:
+                    if release_results[index]['failed']:
+                        cancel(dependent, 'Cancelled, release {0} failed'.format(releases[index]['chart_deploy_name']))
+                    elif dependent in waiting:
+                        waiting[dependent].discard(releases[index]['chart_deploy_name'])
+                        if not waiting[dependent]:
+                            ready.append(dependent)
+    finally:
+        executor.shutdown(wait=True)
+
+    # Releases left wait for each other in a dependency cycle
+    for index in sorted(waiting):
+        release_results[index] = cancelled_result(index, 'Cancelled, dependency cycle, waits for: {0}'.format(
+            ', '.join(sorted(waiting[index]))))
+
+    return release_results
+
+
+def list_release_inventory():
+    """
+    Returns:
+        dict - release inventory of kube context used by current thread, None if releases can't be listed
+    """
+    try:
+        # Only one process on host lists releases of cluster, others wait and take its list
+        with host_lock(get_cluster_cache_name('releases-list')):
+            (inventory, _) = read_release_inventory(module.params['release_cache_ttl'])
+            return inventory if inventory is not None else refresh_release_inventory()
+    except HelmCommandError as err:
+        # Without access to all namespaces, e.g. namespace scoped RBAC, every release is checked with helm status.
+        # Releases of unreachable context fail one by one, other contexts are deployed
+        context_name = getattr(current_kube, 'context', ('', ''))[0]
+        module.warn('Cant list releases{0}, releases are checked one by one. Reason: {1}'.format(
+            ' of kube context {0}'.format(context_name) if context_name else '', err.err))
+        return None
+
+
+def load_release_inventory():
+    """
+    Returns:
+        dict - release inventory of kube context used by current thread, None if releases can't be listed
+    """
+    inventory = read_inventory_facts(module.params['release_inventory'], module.params['release_cache_ttl'])
+    if inventory is None:
+        (inventory, _) = read_release_inventory(module.params['release_cache_ttl'])
+    if inventory is None:
+        inventory = list_release_inventory()
+    return inventory
+
+
+def load_context_inventory(context):
+    """
+    Args:
+        context (tuple): kube context name and kubeconfig
+    Returns:
+        dict - release inventory, None if releases of kube context can't be listed
+    """
+    with kube_context(*context):
+        return load_release_inventory()
+
+
+def run_batch(releases, max_workers):
+    """
+    Args:
+        releases (list): normalized release specs
+        max_workers (int): max number of releases deployed at the same time
+    """
+    values_files = [release['values_file'] for release in releases]
+
+    graph_error = get_release_graph_error(releases)
+    if graph_error:
+        for values_file in values_files:
+            remove_tmp_folder(values_file)
+        return module.exit_json(msg=graph_error, changed=False, failed=True, timings=timings)
+
+    # Dependents start when release is ready, so release with dependents is never waited in background
+    depended_on = set((release['kube_context'], dependency) for release in releases
+                      for dependency in release['depends_on'])
+    for release in releases:
+        if (release['kube_context'], release['chart_deploy_name']) in depended_on:
+            release['chart_wait_mode'] = 'sync'
+
+    contexts = []
+    for release in releases:
+        if (release['kube_context'], release['kubeconfig']) not in contexts:
+            contexts.append((release['kube_context'], release['kubeconfig']))
+
+    try:
+        # Shared work is done once for all releases and kube contexts
+        if contexts == [('', '')]:
+            inventories = {('', ''): load_release_inventory()}
+        else:
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(contexts)))) as executor:
+                inventories = dict(zip(contexts, executor.map(load_context_inventory, contexts)))
+        repo_cache_hits = prepare_repos(releases, module.params['repo_cache_ttl'])
+
+        # Chart directory is packaged once, before it's deployed to every kube context
+        for release in releases:
+            if release['chart_files'] and release['chart_state'] != 'absent' and \
+                    not os.path.exists(release['chart_location']):
+                package_chart(release['chart_location'], release['chart_files'])
+    except HelmCommandError as err:
+        for values_file in values_files:
+            remove_tmp_folder(values_file)
+        return module.exit_json(original_message=err.err, cmd=err.cmd, changed=False, failed=True, timings=timings)
+
+    # Deploy releases in parallel, dependencies first
+    release_results = schedule_releases(releases, max_workers, module.check_mode, inventories)
+
+    for release, release_result in zip(releases, release_results):
+        repo_key = (release['chart_source_name'], release['chart_location'])
+        if repo_key in repo_cache_hits:
+            release_result['repo_cache_hit'] = repo_cache_hits[repo_key]
+
+    for values_file in set(values_files):
         remove_tmp_folder(values_file)
-        return module.exit_json(**result)
+
+    evict_chart_cache(module.params['chart_cache_dir'], module.params['chart_cache_size'],
+                      [path for release in releases for path in get_chart_cache_paths(release)])
+
+    # Every kube context succeeds or fails on its own
+    if module.params['kube_contexts']:
+        result['kube_contexts'] = dict(
+            (context['name'], {'changed': any(_result['changed'] for _result in release_results
+                                              if _result.get('kube_context') == context['name']),
+                               'failed': any(_result['failed'] for _result in release_results
+                                             if _result.get('kube_context') == context['name'])})
+            for context in module.params['kube_contexts'])
+
+    failed_releases = [get_release_label(_result) for _result in release_results
+                       if _result['failed'] and not _result.get('cancelled')]
+    cancelled_releases = [get_release_label(_result) for _result in release_results if _result.get('cancelled')]
+    result['changed'] = any(_result['changed'] for _result in release_results)
+    result['failed'] = len(failed_releases + cancelled_releases) > 0
+    result['results'] = release_results
+    result['jobs'] = [_result['job'] for _result in release_results if 'job' in _result]
+    result['timings'] = timings
+    if failed_releases or cancelled_releases:
+        messages = []
+        if failed_releases:
+            messages.append('Failed releases: {0}'.format(', '.join(failed_releases)))
+        if cancelled_releases:
+            messages.append('Cancelled releases: {0}'.format(', '.join(cancelled_releases)))
+        result['msg'] = result['message'] = '. '.join(messages)
+    else:
+        result['message'] = 'Processed {0} releases'.format(len(release_results))
+    return module.exit_json(**result)
+
+
+# Revisions of helm releases stored as secrets, size is the size of stored release data
+RELEASE_SECRETS_TEMPLATE = ('{{range .items}}{{.metadata.namespace}} {{.metadata.name}} {{.metadata.labels.name}} '
+                            '{{.metadata.labels.version}} {{.metadata.labels.status}} {{len .data.release}}'
+                            '{{"\\n"}}{{end}}')
+
+
+@timed_phase('prune_history')
+def prune_release_history(history_max, check_mode):
+    """
+    Args:
+        history_max (int): number of newest revisions kept for every release
+        check_mode (bool): only report revisions which would be removed
+    Returns:
+        dict - pruned revisions and reclaimed bytes of every release deployed by helm_shell
+    """
+    # Releases deployed by helm_shell to kube context used by current thread
+    managed_releases = set(read_cache_file(get_cluster_cache_name('deployed') + '.json'))
+    prune_result = {'releases': {}, 'reclaimed_bytes': 0}
+    if not managed_releases:
+        return prune_result
+
+    # Revisions of all managed releases are listed with one call, release data is not downloaded
+    release_names = sorted(set(release_key.split('/', 1)[1] for release_key in managed_releases))
+    kubectl_args = ['get', 'secrets', '--all-namespaces', '-l', 'owner=helm,name in ({0})'.format(
+        ','.join(release_names)), '-o', 'go-template=' + RELEASE_SECRETS_TEMPLATE]
+    (_rc, secrets_raw, _err) = run_kubectl(kubectl_args)
+    if _rc:
+        raise HelmCommandError(format_helm_cmd(kubectl_args, 'kubectl'), _err)
+
+    revisions = {}
+    for line in secrets_raw.splitlines():
+        fields = line.split()
+        if len(fields) != 6 or '{0}/{1}'.format(fields[0], fields[2]) not in managed_releases:
+            continue
+        (namespace, secret_name, release_name, revision, status, release_size) = fields
+        revisions.setdefault('{0}/{1}'.format(namespace, release_name), []).append(
+            (int(revision), status, secret_name, int(release_size)))
+
+    # Newest revisions and deployed revision are kept
+    pruned_secrets = {}
+    for release_key in sorted(revisions):
+        for (revision, status, secret_name, release_size) in sorted(revisions[release_key],
+                                                                    reverse=True)[history_max:]:
+            if status == 'deployed':
+                continue
+            release_prune = prune_result['releases'].setdefault(release_key, {'revisions': [], 'reclaimed_bytes': 0})
+            release_prune['revisions'].append(revision)
+            release_prune['reclaimed_bytes'] += release_size
+            prune_result['reclaimed_bytes'] += release_size
+            pruned_secrets.setdefault(release_key.split('/', 1)[0], []).append(secret_name)
+
+    for namespace in [] if check_mode else sorted(pruned_secrets):
+        secret_names = pruned_secrets[namespace]
+        for index in range(0, len(secret_names), 100):
+            kubectl_args = ['delete', 'secret', '-n', namespace, '--ignore-not-found'] + secret_names[index:index + 100]
+            (_rc, _out, _err) = run_kubectl(kubectl_args)
+            if _rc:
+                raise HelmCommandError(format_helm_cmd(kubectl_args, 'kubectl'), _err)
+
+    return prune_result
+
+
+def run_prune(history_max, kube_contexts):
+    """
+    Args:
+        history_max (int): number of newest revisions kept for every release
+        kube_contexts (list): kube contexts with name and kubeconfig, None for current context
+    """
+    if history_max is None or history_max < 1:
+        return module.exit_json(msg='prune_history needs history_max of 1 or more', changed=False, failed=True)
+
+    def prune_context(context):
+        with kube_context(context['name'], context.get('kubeconfig')):
+            try:
+                return prune_release_history(history_max, module.check_mode)
+            except HelmCommandError as err:
+                return dict(original_message=err.err, cmd=err.cmd, failed=True)
+
+    contexts = kube_contexts or [{'name': ''}]
+    with ThreadPoolExecutor(max_workers=max(1, min(module.params['max_workers'], len(contexts)))) as executor:
+        prune_results = list(executor.map(prune_context, contexts))
+
+    failed_contexts = [context['name'] for context, prune_result in zip(contexts, prune_results)
+                       if prune_result.get('failed')]
+    reclaimed_bytes = sum(prune_result.get('reclaimed_bytes', 0) for prune_result in prune_results)
+    result['changed'] = reclaimed_bytes > 0
+    result['failed'] = len(failed_contexts) > 0
+    result['reclaimed_bytes'] = reclaimed_bytes
+    if kube_contexts:
+        result['kube_contexts'] = dict((context['name'], prune_result)
+                                       for context, prune_result in zip(contexts, prune_results))
+    else:
+        result.update(prune_results[0])
+    result['timings'] = timings
+    if failed_contexts and kube_contexts:
+        result['msg'] = result['message'] = 'Failed kube contexts: {0}'.format(', '.join(failed_contexts))
+    elif result['failed']:
+        result['msg'] = result['message'] = 'Cant prune release history'
     else:
+        result['message'] = '{0} {1} bytes of release history'.format(
+            'Would reclaim' if module.check_mode else 'Reclaimed', reclaimed_bytes)
+    return module.exit_json(**result)
+
+
+def run_gather():
+    try:
+        # Cached inventory is returned only when no release was changed since it was listed
+        (inventory, _) = read_release_inventory(module.params['release_cache_ttl'])
+        if inventory is None or inventory['invalid']:
+            inventory = refresh_release_inventory()
+    except HelmCommandError as err:
+        return module.exit_json(original_message=err.err, cmd=err.cmd, changed=False, failed=True, timings=timings)
+
+    result['release_inventory'] = {'updated': inventory['updated'], 'releases': inventory['releases'],
+                                   'cluster': get_kube_identity()}
+    result['message'] = 'Found {0} releases'.format(len(inventory['releases']))
+    result['timings'] = timings
+    return module.exit_json(**result)
+
+
+def run_module():
+    if module.params['gather']:
+        return run_gather()
+
+    # Empty jobs list is polled too, when no release was submitted by async task
+    if module.params['jobs'] is not None:
+        return run_poll(module.params['jobs'], module.params['timeout'])
+
+    kube_contexts = module.params['kube_contexts']
+    if kube_contexts and len(set(context['name'] for context in kube_contexts)) != len(kube_contexts):
+        return module.exit_json(msg='kube_contexts must have unique names', changed=False, failed=True)
+
+    if module.params['prune_history']:
+        return run_prune(module.params['history_max'], kube_contexts)
+
+    # Release specs are deployed to every kube context in parallel
+    if module.params['releases'] or kube_contexts:
+        if module.params['releases']:
+            releases = [get_release_spec(params, module.params) for params in module.params['releases']]
+        else:
+            releases = [get_release_spec(module.params)]
+        if kube_contexts:
+            releases = expand_kube_contexts(releases, kube_contexts)
+        return run_batch(releases, module.params['max_workers'])
+
+    release = get_release_spec(module.params)
+    values_file = release['values_file']
+
+    try:
+        # Get release inventory, from helm_shell_info facts or listed by one task on host for next ones
+        inventory = load_release_inventory()
+
+        # Add/update remote repository
+        repo_cache_hits = prepare_repos([release], module.params['repo_cache_ttl'])
+        if repo_cache_hits:
+            result['repo_cache_hit'] = list(repo_cache_hits.values())[0]
+
+        release_result = deploy_release(release, inventory, module.check_mode)
+    except HelmCommandError as err:
         remove_tmp_folder(values_file)
-        return module.exit_json(msg='Chart {0} is not installed'.format(chart_deploy_name), original_message=msg,
-                                cmd=cmd_str, changed=False, failed=True)
+        if err.cmd:
+            return module.exit_json(original_message=err.err, cmd=err.cmd, changed=False, failed=True,
+                                    timings=timings)
+        return module.exit_json(msg=err.err, changed=False, failed=True, timings=timings)
+
+    remove_tmp_folder(values_file)
+    if release['chart_source_type'] == 'local':
+        evict_chart_cache(module.params['chart_cache_dir'], module.params['chart_cache_size'],
+                          get_chart_cache_paths(release))
+
+    result.update(release_result)
+    result['jobs'] = [release_result['job']] if 'job' in release_result else []
+    result['timings'] = timings
+    return module.exit_json(**result)
 
 
 def main():
-    run_module()
+    if not module.params['profile_file']:
+        return run_module()
+
+    # Module exits with SystemExit, profile is saved on the way out
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        run_module()
+    finally:
+        profiler.disable()
+        profiler.dump_stats(module.params['profile_file'])
 
 
 if __name__ == '__main__':
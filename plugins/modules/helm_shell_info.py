@@ -0,0 +1,44 @@
+#!/usr/bin/python
+
+# Releases are gathered by the helm_shell_info action plugin with helm_shell module, this file is documentation only
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.2',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+DOCUMENTATION = '''
+Lists all helm releases in all namespaces with one `helm list` call and sets them as `helm_releases` fact.
+The fact can be passed to helm_shell as `release_inventory`, so helm_shell tasks don't list releases themselves.
+Depends on `helm` command being available on the host it is executed on.
+Options:
+  release_cache_ttl: seconds while release list cached on the host by helm_shell is returned without helm call,
+    default 300. Cached list is not used after any release was changed by helm_shell.
+  cache_dir: directory on the target host for helm_shell cache files, default ~/.cache/helm_shell
+'''
+
+EXAMPLES = '''
+- name: Gather helm releases
+  helm_shell_info:
+
+- name: Install Rook Ceph Operator
+  helm_shell:
+    namespace: default
+    name: rook-ceph
+    chart_deploy_name: ceph-random
+    release_inventory: "{{ helm_releases }}"
+    source:
+      type: local
+      location: "{{ role_path }}/files/platform/rook"
+'''
+
+RETURN = '''
+ansible_facts:
+  helm_releases:
+    updated: time when releases were listed
+    releases: 'helm list' info (name, namespace, revision, updated, status, chart, app_version) of every release,
+      by "namespace/name" key
+    cluster: digest of kubeconfig files, kube context and API server the releases were listed from, helm_shell uses
+      the facts only on the same cluster
+'''